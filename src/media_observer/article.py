@@ -1,4 +1,5 @@
 import asyncio
+import urllib.parse
 from abc import ABC, abstractmethod
 from attrs import frozen, field, validators
 import cattrs
@@ -147,12 +148,28 @@ class FrontPage(ABC):
     @classmethod
     async def from_snapshot(cls, snapshot: InternetArchiveSnapshot):
         loop = asyncio.get_event_loop()
-        soup = await loop.run_in_executor(None, MagnificentSoup, snapshot.text, "lxml")
+        soup = await loop.run_in_executor(None, cls.parse_html, snapshot)
 
         return cls(
             snapshot, soup, cls.get_top_articles(soup), cls.get_main_article(soup)
         )
 
+    @staticmethod
+    def parse_html(snapshot: InternetArchiveSnapshot) -> MagnificentSoup:
+        soup = MagnificentSoup(snapshot.text, "lxml")
+
+        if snapshot.raw:
+            # Links of a page as originally served are resolved against the
+            # site, and then made to point to the Wayback Machine as they do
+            # in archived pages. (`select` is avoided here as it alters the
+            # class of the elements it returns)
+            for a in soup.find_all("a", href=True):
+                url = urllib.parse.urljoin(snapshot.id.original, a["href"])
+                if url.startswith("http"):
+                    a["href"] = snapshot.id.archived(url)
+
+        return soup
+
 
 @frozen
 class ArchiveCollection:
@@ -17,5 +17,8 @@ class DbConnection(ABC):
     @abstractmethod
     async def execute_insert(self, *args, **kwargs): ...
 
+    @abstractmethod
+    async def execute_many(self, *args, **kwargs): ...
+
     @abstractmethod
     async def commit(self): ...
@@ -2,6 +2,8 @@ import asyncpg
 
 
 class PostgresConnection:
+    dialect = "postgresql"
+
     def __init__(self, coro):
         self.coro = coro
 
@@ -21,6 +23,9 @@ class PostgresConnection:
     async def execute_fetchall(self, *args, **kwargs):
         return await self.conn.fetch(*args, **kwargs)
 
+    async def execute_many(self, stmt, args_list):
+        return await self.conn.executemany(stmt, args_list)
+
     def transaction(self):
         return self.conn.transaction()
 
@@ -29,7 +34,8 @@ class PostgresBackend:
     def __init__(self, pool):
         self.pool = pool
 
-    def get_connection(self):
+    def get_connection(self, readonly: bool = False):
+        # All connections of the pool can be used both for reading and writing
         return PostgresConnection(self.pool.acquire())
 
     @staticmethod
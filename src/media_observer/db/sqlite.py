@@ -1,53 +1,157 @@
 import asyncio
+import re
+import sqlite3
+from datetime import datetime, timezone
 import aiosqlite
 
+from config import settings
+
+
+# Datetimes are stored as ISO strings in UTC, so that they can be compared
+# (and sorted) as plain strings whatever timezone they were created in.
+sqlite3.register_adapter(
+    datetime, lambda dt: dt.astimezone(timezone.utc).isoformat(" ")
+)
+sqlite3.register_converter(
+    "timestamp", lambda b: datetime.fromisoformat(b.decode()).astimezone(timezone.utc)
+)
+sqlite3.register_converter("boolean", lambda b: bool(int(b)))
+
+
+class SqliteTransaction:
+    def __init__(self, conn, begin_stmt):
+        self.conn = conn
+        self.begin_stmt = begin_stmt
+
+    async def __aenter__(self):
+        await self.conn.execute(self.begin_stmt)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.conn.execute("COMMIT")
+        else:
+            await self.conn.execute("ROLLBACK")
+
 
 class SqliteConnection:
-    def __init__(self, conn_str):
-        self.connection_string = conn_str
-        self.semaphore = asyncio.Semaphore(1)
+    dialect = "sqlite"
+
+    def __init__(self, backend, readonly):
+        self.backend = backend
+        self.readonly = readonly
 
     async def __aenter__(self):
-        await self.semaphore.acquire()
-        self.conn = await aiosqlite.connect(self.connection_string)
+        self.conn = await self.backend.acquire(self.readonly)
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        # Reproduce asyncpg' behaviour where commit is implicit
-        await self.conn.commit()
-        await self.conn.close()
+        # A transaction that was left open would leak into the next user of
+        # this connection.
+        if self.conn.in_transaction:
+            await self.conn.rollback()
+
+        self.backend.release(self.conn, self.readonly)
         self.conn = None
-        self.semaphore.release()
 
-    async def execute(self, *args, **kwargs):
-        return await self.conn.execute(*args, **kwargs)
+    async def execute(self, stmt, *args):
+        return await self.conn.execute(self._translate(stmt), args)
 
-    async def execute_fetchall(self, *args, **kwargs):
-        return await self.conn.execute_fetchall(*args, **kwargs)
+    async def execute_fetchall(self, stmt, *args):
+        return await self.conn.execute_fetchall(self._translate(stmt), args)
 
-    async def execute_insert(self, *args, **kwargs):
-        return await self.conn.execute_insert(*args, **kwargs)
+    async def execute_insert(self, stmt, *args):
+        return await self.conn.execute_insert(self._translate(stmt), args)
 
-    def transaction(self):
-        class DummyTransaction:
-            async def __aenter__(self):
-                return self
+    async def execute_many(self, stmt, args_list):
+        return await self.conn.executemany(self._translate(stmt), args_list)
 
-            async def __aexit__(self, exc_type, exc, tb):
-                return
+    def transaction(self):
+        # Taking the write lock right away avoids having to upgrade a read
+        # transaction into a write transaction, which may fail if another
+        # connection wrote in-between.
+        return SqliteTransaction(
+            self.conn, "BEGIN" if self.readonly else "BEGIN IMMEDIATE"
+        )
 
-        return DummyTransaction()
+    @staticmethod
+    def _translate(stmt):
+        # asyncpg-style placeholders ($1, $2..) are turned into SQLite's
+        # numbered placeholders (?1, ?2..) that have the same semantics.
+        return re.sub(r"\$(\d+)", r"?\1", stmt)
 
 
 class SqliteBackend:
-    def __init__(self, conn_path):
-        self.conn_path = conn_path
+    # SQLite allows many concurrent readers but a single writer : write connections
+    # are thus handed out one at a time while read connections are pooled.
+    def __init__(self, writer, readers):
+        self.writer = writer
+        self.writer_lock = asyncio.Lock()
+        self.readers = asyncio.Queue()
+        for r in readers:
+            self.readers.put_nowait(r)
+
+    def get_connection(self, readonly: bool = False):
+        return SqliteConnection(self, readonly)
 
-    def get_connection(self):
-        return SqliteConnection(self.conn_path)
+    async def acquire(self, readonly: bool):
+        if readonly:
+            return await self.readers.get()
+        else:
+            await self.writer_lock.acquire()
+            return self.writer
+
+    def release(self, conn, readonly: bool):
+        if readonly:
+            self.readers.put_nowait(conn)
+        else:
+            self.writer_lock.release()
 
     @staticmethod
     async def create(conn_path):
-        return SqliteBackend(conn_path)
+        writer = await SqliteBackend._connect(conn_path)
+        # The WAL mode is persistent, and it is what allows readers not to be
+        # blocked by the writer (and vice-versa)
+        await writer.execute_fetchall("PRAGMA journal_mode = WAL")
+
+        readers = [
+            await SqliteBackend._connect(conn_path, readonly=True)
+            for _ in range(settings.sqlite.nb_readers)
+        ]
+
+        return SqliteBackend(writer, readers)
+
+    @staticmethod
+    async def _connect(conn_path, readonly: bool = False):
+        conn = await aiosqlite.connect(
+            conn_path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # Transactions are explicitly handled in `SqliteTransaction`, any
+            # statement that is executed outside of it is committed right away, as in asyncpg.
+            isolation_level=None,
+        )
+        conn.row_factory = aiosqlite.Row
+
+        pragmas = [
+            f"busy_timeout = {settings.sqlite.busy_timeout_ms}",
+            f"synchronous = {settings.sqlite.synchronous}",
+            f"cache_size = -{settings.sqlite.cache_size_kib}",
+            f"mmap_size = {settings.sqlite.mmap_size}",
+            "foreign_keys = ON",
+        ]
+        if readonly:
+            pragmas.append("query_only = ON")
+
+        for p in pragmas:
+            # Some pragmas return a value, that must be consumed so that no
+            # statement is left pending on the connection.
+            await conn.execute_fetchall(f"PRAGMA {p}")
+
+        return conn
+
+    async def close(self):
+        while not self.readers.empty():
+            await self.readers.get_nowait().close()
 
-    async def close(self): ...
+        async with self.writer_lock:
+            await self.writer.close()
@@ -1,8 +1,7 @@
 import asyncio
 from loguru import logger
-from itertools import islice
 from collections import defaultdict
-from typing import Any
+from typing import Any, AsyncIterator
 from attrs import frozen
 from numpy.typing import NDArray
 from sentence_transformers import SentenceTransformer
@@ -10,18 +9,28 @@ from sentence_transformers import SentenceTransformer
 from media_observer.storage import Storage
 
 
-def batched(iterable, n):
+async def abatched(aiterable, n):
     """
-    Batch data into tuples of length n. The last batch may be shorter.
-        `batched('ABCDEFG', 3) --> ABC DEF G`
+    Batch data from an async iterable into tuples of length n. The last batch may be shorter.
 
-    Straight from : https://docs.python.org/3.11/library/itertools.html#itertools-recipes
+    An async equivalent of : https://docs.python.org/3.11/library/itertools.html#itertools-recipes
     """
     if n < 1:
         raise ValueError("n must be at least one")
-    it = iter(iterable)
-    while batch := tuple(islice(it, n)):
-        yield batch
+    batch = []
+    async for item in aiterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield tuple(batch)
+            batch = []
+    if batch:
+        yield tuple(batch)
+
+
+async def prepend(item, aiterable):
+    yield item
+    async for i in aiterable:
+        yield i
 
 
 @frozen
@@ -30,9 +39,9 @@ class EmbeddingsJob:
     text: NDArray
 
     @staticmethod
-    async def create(storage: Storage):
-        all_titles = await storage.list_all_titles_without_embedding()
-        return [EmbeddingsJob(t["id"], t["text"]) for t in all_titles]
+    async def iter_all(storage: Storage):
+        async for t in storage.iter_titles_without_embedding():
+            yield EmbeddingsJob(t["id"], t["text"])
 
 
 @frozen
@@ -58,12 +67,11 @@ class EmbeddingsWorker:
 
     async def store_embeddings(self, embeddings_by_id: dict):
         logger.debug(f"Storing {len(embeddings_by_id)} embeddings")
-        for i, embed in embeddings_by_id.items():
-            await self.storage.add_embedding(i, embed)
+        await self.storage.add_embeddings(embeddings_by_id)
 
-    async def run(self, jobs: list[EmbeddingsJob]):
+    async def run(self, jobs: AsyncIterator[EmbeddingsJob]):
         batch_size = 64
-        for batch in batched(jobs, batch_size):
+        async for batch in abatched(jobs, batch_size):
             embeddings_by_id = self.compute_embeddings_for(
                 {j.title_id: j.text for j in batch}
             )
@@ -79,8 +87,9 @@ async def main():
     storage = await Storage.create()
 
     logger.info("Starting embeddings service..")
-    jobs = await EmbeddingsJob.create(storage)
-    if jobs:
+    jobs = EmbeddingsJob.iter_all(storage)
+    # The model is only loaded if there is at least one title to handle
+    if (first_job := await anext(jobs, None)) is not None:
         loop = asyncio.get_event_loop()
         worker = await loop.run_in_executor(
             None,
@@ -88,7 +97,7 @@ async def main():
             storage,
             "dangvantuan/sentence-camembert-large",
         )
-        await worker.run(jobs)
+        await worker.run(prepend(first_job, jobs))
 
     logger.info("Embeddings service exiting")
 
@@ -0,0 +1,73 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from loguru import logger
+
+from media_observer.article import ArchiveCollection, FrontPage
+from media_observer.internet_archive import InternetArchiveClient
+from media_observer.medias import media_collection
+
+
+# This module compares, for the latest snapshot of each site, the archived page
+# (as the Wayback Machine displays it) and the page as originally served (the
+# "id_" mode) : sizes, parse times, and whether the same articles are found.
+
+
+def articles(page: FrontPage) -> list[tuple[str, str]]:
+    return [
+        (a.title, str(a.url))
+        for a in [page.main_article.article] + [t.article for t in page.top_articles]
+    ]
+
+
+async def parse(collection: ArchiveCollection, snapshot) -> tuple[FrontPage, float]:
+    start = time.perf_counter()
+    page = await collection.FrontPageClass.from_snapshot(snapshot)
+    return page, time.perf_counter() - start
+
+
+async def compare(ia: InternetArchiveClient, collection: ArchiveCollection):
+    dt = datetime.now(ZoneInfo("UTC")) - timedelta(days=1)
+    snapshot_id = await ia.get_snapshot_id_closest_to(collection.url, dt)
+
+    archived = await ia.fetch(snapshot_id, raw=False)
+    raw = await ia.fetch(snapshot_id, raw=True)
+    archived_page, archived_time = await parse(collection, archived)
+    raw_page, raw_time = await parse(collection, raw)
+
+    archived_size = len(archived.text.encode())
+    raw_size = len(raw.text.encode())
+    same = articles(archived_page) == articles(raw_page)
+
+    logger.info(
+        f"{collection.name} : {archived_size} -> {raw_size} bytes "
+        f"({raw_size / archived_size:.0%}), parsed in {archived_time * 1000:.0f} -> "
+        f"{raw_time * 1000:.0f} ms, same articles : {same}"
+    )
+
+    return archived_size, raw_size, archived_time, raw_time
+
+
+async def main():
+    totals = [0, 0, 0.0, 0.0]
+
+    async with InternetArchiveClient.create() as ia:
+        for collection in media_collection.values():
+            try:
+                results = await compare(ia, collection)
+            except Exception as e:
+                logger.error(f"{collection.name} : could not compare ({e!r})")
+                continue
+
+            totals = [t + r for t, r in zip(totals, results)]
+
+    archived_size, raw_size, archived_time, raw_time = totals
+    logger.info(
+        f"Total : {archived_size} -> {raw_size} bytes, "
+        f"parsed in {archived_time:.2f} -> {raw_time:.2f} s"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
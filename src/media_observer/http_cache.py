@@ -0,0 +1,112 @@
+import asyncio
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+
+
+class HttpCache:
+    # Bodies of HTTP responses are stored compressed in a SQLite file, by URL.
+    # Each response expires after its own `ttl` (or never if it is None), and
+    # the least recently used responses are evicted once the bodies take more
+    # than `max_size` bytes.
+    #
+    # Responses are read and written in a thread of their own, so that the
+    # event loop is not blocked meanwhile.
+    def __init__(self, file_path: Path, max_size: int) -> None:
+        self.max_size = max_size
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.conn = sqlite3.connect(
+            file_path, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_idx_accessed_at ON responses (accessed_at)"
+        )
+
+        [(self.size,)] = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses"
+        ).fetchall()
+
+    async def get(self, key: str) -> str | None:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._get, key)
+
+    def _get(self, key: str) -> str | None:
+        row = self.conn.execute(
+            "SELECT body, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        body, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            self._delete(key, len(body))
+            return None
+
+        self.conn.execute(
+            "UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key)
+        )
+        return zlib.decompress(body).decode()
+
+    async def set(self, key: str, text: str, ttl: timedelta | None):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._set, key, text, ttl)
+
+    def _set(self, key: str, text: str, ttl: timedelta | None):
+        body = zlib.compress(text.encode())
+        now = time.time()
+        expires_at = now + ttl.total_seconds() if ttl is not None else None
+
+        [(previous_size,)] = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses WHERE key = ?",
+            (key,),
+        ).fetchall()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            (key, body, expires_at, now),
+        )
+        self.size += len(body) - previous_size
+
+        if self.size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        # Expired responses go first, then the least recently used ones
+        self.conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        rows = self.conn.execute(
+            "SELECT key, LENGTH(body) FROM responses ORDER BY accessed_at DESC"
+        )
+
+        # Some room is made so that evictions do not happen on every insertion
+        target_size = 0.9 * self.max_size
+        size = 0
+        evicted = []
+        for key, length in rows:
+            if size + length > target_size:
+                evicted.append((key,))
+            else:
+                size += length
+
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.size = size
+
+    def _delete(self, key: str, length: int):
+        self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self.size -= length
+
+    def close(self):
+        self.executor.shutdown()
+        self.conn.close()
@@ -1,19 +1,24 @@
+import asyncio
 import pickle
+import time as time_module
+import urllib.parse
+from collections import OrderedDict, defaultdict
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from attrs import frozen, field
 from typing import Optional, ClassVar, NewType
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, time, timedelta
 from zoneinfo import ZoneInfo
 import cattrs
 from aiohttp.client import (
     ClientSession,
-    TCPConnector,
-    ClientResponseError,
     ClientConnectorError,
+    ClientResponseError,
 )
-from aiolimiter import AsyncLimiter
+from loguru import logger
 
 from config import settings
+from media_observer.http_cache import HttpCache
 
 
 tz_utc = ZoneInfo("UTC")
@@ -61,6 +66,7 @@ class CdxRequest:
     from_: Optional[datetime] = field(default=None, validator=has_timezone)
     to_: Optional[datetime] = field(default=None, validator=has_timezone)
     limit: Optional[int] = None
+    collapse: Optional[str] = None
 
     translation_dict: ClassVar[dict] = dict(from_="from", to_="to")
     datetime_format: ClassVar[str] = "%Y%m%d%H%M%S"
@@ -69,6 +75,7 @@ class CdxRequest:
         return {
             self._translate_key(k): self._stringify_value(v)
             for k, v in cattrs.unstructure(self).items()
+            if v is not None
         }
 
     @classmethod
@@ -95,149 +102,378 @@ class SnapshotNotYetAvailable(Exception):
 class InternetArchiveSnapshotId:
     timestamp: Timestamp
     original: str
+    # Digest and length of the content of the capture, as given by the CDX API :
+    # captures with the same digest have the same content
+    digest: str | None = field(default=None, eq=False)
+    length: int | None = field(default=None, eq=False)
 
     @property
     def url(self):
-        return f"http://web.archive.org/web/{timestamp_to_str(self.timestamp)}/{self.original}"
+        return self.archived(self.original)
+
+    @property
+    def raw_url(self):
+        # The page as it was originally served, without the toolbar and the
+        # rewritten links that the Wayback Machine adds
+        return f"http://web.archive.org/web/{timestamp_to_str(self.timestamp)}id_/{self.original}"
+
+    def archived(self, url: str) -> str:
+        return f"http://web.archive.org/web/{timestamp_to_str(self.timestamp)}/{url}"
 
     @staticmethod
     def from_record(rec: CdxRecord):
-        return InternetArchiveSnapshotId(timestamp=rec.timestamp, original=rec.original)
+        return InternetArchiveSnapshotId(
+            timestamp=rec.timestamp,
+            original=rec.original,
+            digest=rec.digest,
+            length=rec.length,
+        )
 
 
 @frozen
 class InternetArchiveSnapshot:
     id: InternetArchiveSnapshotId
     text: str = field(repr=False)
+    # Whether `text` is the page as originally served (see `raw_url`)
+    raw: bool = False
 
 
-class RateLimitedConnector(TCPConnector):
-    def __init__(self, *args, **kwargs):
-        limiter_max_rate = kwargs.pop("limiter_max_rate")
-        limiter_time_period = kwargs.pop("limiter_time_period", 60)
-        self._limiter = AsyncLimiter(limiter_max_rate, limiter_time_period)
-        super().__init__(*args, **kwargs)
+@frozen
+class CdxWindow:
+    snapshots: list[InternetArchiveSnapshotId]
+    fetched_at: datetime
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    # The "Retry-After" header holds either a number of seconds or a date
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    try:
+        return (parsedate_to_datetime(value) - datetime.now(tz_utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    # Requests are spaced so that at most `rate` of them are sent per second.
+    # The rate grows additively for as long as requests succeed, and is cut
+    # multiplicatively whenever the server asks to slow down (AIMD). The
+    # requests that were sent along with the one that was throttled are likely
+    # throttled too : the rate is cut only once per `cooldown` seconds.
+    def __init__(
+        self,
+        initial_rate: float,
+        min_rate: float,
+        max_rate: float,
+        increase: float,
+        decrease_factor: float,
+        cooldown: float,
+    ) -> None:
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._next_at = 0.0
+        self._cooldown_until = 0.0
+
+    async def acquire(self):
+        now = time_module.monotonic()
+        at = max(now, self._next_at)
+        self._next_at = at + 1 / self.rate
+
+        await asyncio.sleep(at - now)
+
+    def on_success(self):
+        # The rate grows by about `increase` for each second of successful requests
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttled(self, retry_after: float | None):
+        now = time_module.monotonic()
+        if retry_after is not None:
+            self._next_at = max(self._next_at, now + retry_after)
+
+        if now < self._cooldown_until:
+            return
+
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._cooldown_until = now + self.cooldown
+        logger.warning(f"Slowing down to {self.rate:.2f} requests per second")
 
-    async def connect(self, req, *args, **kwargs):
-        async with self._limiter:
-            return await super().connect(req, *args, **kwargs)
+    @staticmethod
+    def create():
+        return AdaptiveRateLimiter(
+            initial_rate=settings.internet_archive.initial_rate,
+            min_rate=settings.internet_archive.min_rate,
+            max_rate=settings.internet_archive.max_rate,
+            increase=settings.internet_archive.rate_increase,
+            decrease_factor=settings.internet_archive.rate_decrease_factor,
+            cooldown=settings.internet_archive.rate_decrease_cooldown,
+        )
 
 
-@frozen
-class ErrorRateLimiter:
-    name: str
-    file_path: Path
-    relaxation_duration: timedelta
+class CircuitOpenError(Exception):
+    def __init__(self, open_until: datetime, *args) -> None:
+        super().__init__(*args)
+        self.open_until = open_until
 
-    def notify(self):
-        with open(self.file_path, "wb") as f:
-            pickle.dump(datetime.now(), f)
-
-    def raise_if_not_relaxed(self):
-        time_to_relaxation_end = self._delay_since_last_error - self.relaxation_duration
-        if time_to_relaxation_end < timedelta(0):
-            raise RuntimeError(
-                "Relaxation duration not yet elapsed after last "
-                f"error '{self.name}' that occurred {self._delay_since_last_error} ago"
-                f"\nPlease wait another {-time_to_relaxation_end}"
-            )
 
-    @property
-    def _delay_since_last_error(self):
+class TransientResponseError(ClientResponseError):
+    # An error response ("429 Too Many Requests" or 5xx) that is expected to
+    # go away after a while, unlike the other 4xx responses
+    ...
+
+
+class CircuitBreaker:
+    # After `failure_threshold` consecutive failures, the circuit "opens" : no
+    # request is allowed until `open_until`. The first request after that is a
+    # trial, that closes the circuit if it succeeds or opens it again if it
+    # fails. The state is only written to `file_path` when the circuit opens or
+    # closes, so that it is kept across restarts.
+    def __init__(
+        self, file_path: Path, failure_threshold: int, open_duration: timedelta
+    ) -> None:
+        self.file_path = file_path
+        self.failure_threshold = failure_threshold
+        self.open_duration = open_duration
+        self.nb_failures = 0
+
         try:
             with open(self.file_path, "rb") as f:
-                last_error_dt = pickle.load(f)
+                self.open_until = pickle.load(f)
         except FileNotFoundError:
-            last_error_dt = datetime.min
+            self.open_until = None
+
+        if self.open_until is not None:
+            # The circuit was open when the last process exited
+            self.nb_failures = failure_threshold
+
+    def check(self):
+        if self.open_until is None:
+            return
+
+        now = datetime.now(tz_utc)
+        if now < self.open_until:
+            raise CircuitOpenError(
+                self.open_until,
+                f"No request is sent to the Internet Archive until {self.open_until}, "
+                f"after {self.nb_failures} consecutive failures",
+            )
 
-        return datetime.now() - last_error_dt
+        # Other requests wait for the outcome of this trial (or for the trial
+        # to time out)
+        self.open_until = now + self.open_duration
+
+    def on_success(self):
+        self.nb_failures = 0
+        if self.open_until is not None:
+            logger.info("Requests to the Internet Archive succeed again")
+            self._set_open_until(None)
+
+    def on_failure(self, retry_after: float | None = None):
+        self.nb_failures += 1
+        if self.nb_failures >= self.failure_threshold:
+            duration = max(self.open_duration, timedelta(seconds=retry_after or 0))
+            logger.warning(
+                f"{self.nb_failures} consecutive failures, no request will be sent "
+                f"to the Internet Archive during {duration}"
+            )
+            self._set_open_until(datetime.now(tz_utc) + duration)
+
+    def _set_open_until(self, open_until: datetime | None):
+        self.open_until = open_until
+        with open(self.file_path, "wb") as f:
+            pickle.dump(open_until, f)
+
+    @staticmethod
+    def create():
+        return CircuitBreaker(
+            Path(settings.internet_archive.circuit_state_file),
+            settings.internet_archive.circuit_failure_threshold,
+            timedelta(seconds=settings.internet_archive.circuit_open_duration),
+        )
 
 
 @frozen
 class InternetArchiveClient:
     # https://github.com/internetarchive/wayback/tree/master/wayback-cdx-server
     session: ClientSession
-    error_429_rate_limiter: ClassVar[ErrorRateLimiter] = ErrorRateLimiter(
-        "429 HTTP",
-        Path("./error_file_429.pickle"),
-        timedelta(seconds=settings.internet_archive.relaxation_time_after_error_429),
-    )
-    error_connect_rate_limiter: ClassVar[ErrorRateLimiter] = ErrorRateLimiter(
-        "Connection",
-        Path("./error_file_connect.pickle"),
-        timedelta(
-            seconds=settings.internet_archive.relaxation_time_after_error_connect
-        ),
-    )
+    cache: HttpCache | None = None
+    rate_limiter: AdaptiveRateLimiter = field(factory=AdaptiveRateLimiter.create)
+    circuit_breaker: CircuitBreaker = field(factory=CircuitBreaker.create)
     search_url: ClassVar[str] = "http://web.archive.org/cdx/search/cdx"
+    # Snapshots farther than this from the requested time are not considered
+    search_margin: ClassVar[timedelta] = timedelta(hours=6.0)
+    # Results of the CDX searches, by (url, day), most recently used last
+    cdx_windows: OrderedDict = field(factory=OrderedDict, init=False)
+    cdx_locks: defaultdict = field(
+        factory=lambda: defaultdict(asyncio.Lock), init=False
+    )
+    # Downloads in progress, by (snapshot id, raw)
+    fetches: dict = field(factory=dict, init=False)
 
     async def search_snapshots(
-        self, req: CdxRequest
+        self, req: CdxRequest, cache_ttl: timedelta | None = timedelta(0)
     ) -> list[InternetArchiveSnapshotId]:
         def to_snapshot_id(line):
             record = CdxRecord.parse_line(line)
             return InternetArchiveSnapshotId.from_record(record)
 
-        resp = await self._get(self.search_url, req.into_params())
+        resp = await self._get(self.search_url, req.into_params(), cache_ttl)
 
         return [to_snapshot_id(line) for line in resp.splitlines()]
 
-    async def fetch(self, id_: InternetArchiveSnapshotId) -> InternetArchiveSnapshot:
-        resp = await self._get(id_.url)
-        return InternetArchiveSnapshot(id_, resp)
+    async def fetch(
+        self, id_: InternetArchiveSnapshotId, raw: bool | None = None
+    ) -> InternetArchiveSnapshot:
+        if raw is None:
+            raw = settings.internet_archive.fetch_raw
+
+        # Several searches often end up on the same snapshot : concurrent
+        # fetches of a snapshot share a single download (the later ones are
+        # answered by the cache).
+        key = (id_, raw)
+        if (task := self.fetches.get(key)) is None:
+            task = asyncio.ensure_future(self._fetch(id_, raw))
+            task.add_done_callback(lambda _: self.fetches.pop(key, None))
+            self.fetches[key] = task
+
+        # The download goes on even if one of the callers is cancelled
+        return await asyncio.shield(task)
+
+    async def _fetch(
+        self, id_: InternetArchiveSnapshotId, raw: bool
+    ) -> InternetArchiveSnapshot:
+        # A snapshot at a given timestamp never changes
+        resp = await self._get(id_.raw_url if raw else id_.url, cache_ttl=None)
+        return InternetArchiveSnapshot(id_, resp, raw)
 
     async def get_snapshot_id_closest_to(self, url, dt):
-        req = CdxRequest.create(
-            url=url,
-            from_=dt - timedelta(hours=6.0),
-            # It does not make sense to ask for snapshots in the future.
-            # In the case where the requested `dt` is in the future, this
-            # also allows to always send a new actual request and not
-            # hit the cache, but this is obviously an implementation detail
-            # of the HTTP layer that this client should not be aware of..
-            to_=min(dt + timedelta(hours=6.0), datetime.now(tz_utc)),
-            filter="statuscode:200",
-            # Just to be safe, add an arbitrary limit to the number of values returned
-            limit=100,
-        )
+        all_snaps = [
+            s
+            for s in await self._search_snapshots_around(url, dt)
+            if abs(s.timestamp - dt) <= self.search_margin
+        ]
 
-        all_snaps = await self.search_snapshots(req)
         if all_snaps:
             return min(all_snaps, key=lambda s: abs(s.timestamp - dt))
         else:
             raise SnapshotNotYetAvailable(dt)
 
+    async def _search_snapshots_around(
+        self, url, dt
+    ) -> list[InternetArchiveSnapshotId]:
+        # Snapshots are searched for a whole (UTC) day at once, with margins
+        # that cover the neighbourhood of any time of that day : the searches
+        # for the other hours of that day are then answered from memory.
+        day = dt.astimezone(tz_utc).date()
+        key = (url, day)
+
+        async with self.cdx_locks[key]:
+            window = self.cdx_windows.get(key)
+
+            # Snapshots may have been taken around `dt` since the last search
+            if window is None or window.fetched_at < dt + self.search_margin:
+                start = datetime.combine(day, time(), tzinfo=tz_utc)
+                end = start + timedelta(days=1) + self.search_margin
+                fetched_at = datetime.now(tz_utc)
+                req = CdxRequest.create(
+                    url=url,
+                    from_=start - self.search_margin,
+                    # The end of the window may be in the future : it is kept
+                    # as is so that the request (and its cache key) is the
+                    # same until the window is over.
+                    to_=end,
+                    filter="statuscode:200",
+                    # At most one snapshot every 10 minutes
+                    collapse="timestamp:11",
+                    # Just to be safe, add an arbitrary limit to the number of values returned
+                    limit=1000,
+                )
+                # Snapshots can still be added to a window that is not over
+                cache_ttl = timedelta(
+                    seconds=settings.http_cache.cdx_closed_window_ttl
+                    if end < fetched_at
+                    else settings.http_cache.cdx_open_window_ttl
+                )
+                window = CdxWindow(
+                    await self.search_snapshots(req, cache_ttl), fetched_at
+                )
+                self.cdx_windows[key] = window
+
+            self.cdx_windows.move_to_end(key)
+
+        while len(self.cdx_windows) > settings.internet_archive.cdx_cache_size:
+            evicted, _ = self.cdx_windows.popitem(last=False)
+            self.cdx_locks.pop(evicted, None)
+
+        return window.snapshots
+
     async def __aenter__(self):
         await self.session.__aenter__()
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
+        if self.cache is not None:
+            self.cache.close()
         return await self.session.__aexit__(exc_type, exc, tb)
 
-    async def _get(self, url, params=None):
-        self.error_429_rate_limiter.raise_if_not_relaxed()
-        self.error_connect_rate_limiter.raise_if_not_relaxed()
+    async def _get(self, url, params=None, cache_ttl: timedelta | None = timedelta(0)):
+        # Responses are cached for `cache_ttl` (forever if None, not at all if 0)
+        cache_key = f"{url}?{urllib.parse.urlencode(sorted((params or {}).items()))}"
+        use_cache = self.cache is not None and cache_ttl != timedelta(0)
+
+        if use_cache and (text := await self.cache.get(cache_key)) is not None:
+            return text
+
+        self.circuit_breaker.check()
+        await self.rate_limiter.acquire()
 
         try:
             async with self.session.get(
                 url, allow_redirects=True, params=params
             ) as resp:
-                try:
-                    resp.raise_for_status()
-                    return await resp.text()
-                except ClientResponseError as e:
-                    if e.code == 429:
-                        self.error_429_rate_limiter.notify()
-                    raise e
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+
+                if resp.status in [429, 503]:
+                    self.rate_limiter.on_throttled(retry_after)
+                    self.circuit_breaker.on_failure(retry_after)
+                elif resp.status >= 500:
+                    self.circuit_breaker.on_failure()
+                else:
+                    self.rate_limiter.on_success()
+                    self.circuit_breaker.on_success()
+
+                if resp.status == 429 or resp.status >= 500:
+                    raise TransientResponseError(
+                        resp.request_info,
+                        resp.history,
+                        status=resp.status,
+                        message=resp.reason or "",
+                        headers=resp.headers,
+                    )
+                resp.raise_for_status()
+                text = await resp.text()
         except ClientConnectorError as e:
-            self.error_connect_rate_limiter.notify()
+            self.circuit_breaker.on_failure()
             raise e
 
+        if use_cache:
+            await self.cache.set(cache_key, text, cache_ttl)
+        return text
+
     @staticmethod
     def create():
-        conn = RateLimitedConnector(
-            limiter_max_rate=settings.internet_archive.limiter_max_rate,
-            limiter_time_period=settings.internet_archive.limiter_time_period,
+        session = ClientSession()
+        cache = HttpCache(
+            Path(settings.http_cache.file_path),
+            settings.http_cache.max_size_mb * 1024 * 1024,
         )
-        session = ClientSession(connector=conn)
-        return InternetArchiveClient(session)
+        return InternetArchiveClient(session, cache)
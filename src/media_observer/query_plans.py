@@ -0,0 +1,261 @@
+import asyncio
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import asyncpg
+from pathlib import Path
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from loguru import logger
+
+from media_observer.article import MainArticle, TopArticle
+from media_observer.internet_archive import (
+    InternetArchiveSnapshot,
+    InternetArchiveSnapshotId,
+)
+from media_observer.medias import media_collection
+from media_observer.storage import Storage
+from media_observer.db.sqlite import SqliteBackend
+from media_observer.db.postgres import PostgresBackend
+
+
+# This module checks that the read queries of `Storage` are served by indexes :
+# a temporary database is filled with synthetic front pages, then every query
+# sent by the read methods of `Storage` is run through EXPLAIN (EXPLAIN QUERY
+# PLAN on SQLite, EXPLAIN (FORMAT JSON) on PostgreSQL), and the check fails if
+# any of them scans a whole table.
+
+
+# Those methods return (or look through) whole tables by design
+allowed_full_scans = [
+    "list_sites",
+    "load_embeddings",
+]
+
+
+class ExplainingConnection:
+    def __init__(self, conn, plans):
+        self.conn = conn
+        self.plans = plans
+
+    async def __aenter__(self):
+        await self.conn.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self.conn.__aexit__(exc_type, exc, tb)
+
+    async def execute_fetchall(self, stmt, *args):
+        self.plans.append((stmt, await self.explain(stmt, *args)))
+
+        return await self.conn.execute_fetchall(stmt, *args)
+
+    async def explain(self, stmt, *args) -> list[str]:
+        if self.conn.dialect == "sqlite":
+            plan = await self.conn.execute_fetchall(f"EXPLAIN QUERY PLAN {stmt}", *args)
+            return [r["detail"] for r in plan]
+
+        # The planner rightly prefers sequential scans on small tables : they
+        # are disabled, so that one only shows up when no index can serve the
+        # query.
+        await self.conn.execute("SET enable_seqscan = off")
+        try:
+            [(plan,)] = await self.conn.execute_fetchall(
+                f"EXPLAIN (FORMAT JSON) {stmt}", *args
+            )
+        finally:
+            await self.conn.execute("RESET enable_seqscan")
+
+        return list(plan_nodes(json.loads(plan)[0]["Plan"]))
+
+    def transaction(self):
+        return self.conn.transaction()
+
+
+class ExplainingBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.plans = []
+
+    def get_connection(self, readonly: bool = False):
+        return ExplainingConnection(self.backend.get_connection(readonly), self.plans)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def plan_nodes(node: dict):
+    # The nodes of a PostgreSQL plan, as "<node type> <relation>" lines
+    yield " ".join(filter(None, [node["Node Type"], node.get("Relation Name")]))
+
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def full_scans(plan: list[str]) -> list[str]:
+    # Subqueries and CTEs also appear as "SCAN <name>" in SQLite plans once
+    # they are computed, which is harmless.
+    subqueries = {
+        m.group(2)
+        for detail in plan
+        if (m := re.match(r"(CO-ROUTINE|MATERIALIZE) (\w+)", detail))
+    }
+
+    return [
+        detail
+        for detail in plan
+        if (m := re.match(r"SCAN (\w+)", detail))
+        and m.group(1) not in subqueries
+        and m.group(1) != "CONSTANT"
+    ] + [detail for detail in plan if detail.startswith("Seq Scan ")]
+
+
+def snapshot_url(collection, dt: datetime, article_idx: int) -> str:
+    return (
+        f"http://web.archive.org/web/{dt:%Y%m%d%H%M%S}/"
+        f"{collection.url}/article_{article_idx}"
+    )
+
+
+def synthetic_pages(nb_pages_per_site: int):
+    start = datetime(2024, 1, 1, tzinfo=ZoneInfo("UTC"))
+
+    for collection in media_collection.values():
+        for idx in range(nb_pages_per_site):
+            dt = start + timedelta(hours=6 * idx)
+            snapshot = InternetArchiveSnapshot(
+                InternetArchiveSnapshotId(dt, collection.url, f"DIGEST{idx}"), ""
+            )
+
+            # Consecutive front pages share most of their articles, as they do
+            # on actual sites.
+            main = MainArticle.create(
+                f"{collection.name} headline {idx}", snapshot_url(collection, dt, idx)
+            )
+            top_articles = [
+                TopArticle.create(
+                    f"{collection.name} title {idx + rank}",
+                    snapshot_url(collection, dt, idx + rank),
+                    rank,
+                )
+                for rank in range(1, 11)
+            ]
+
+            page = collection.FrontPageClass(snapshot, None, top_articles, main)
+            yield collection, page, dt
+
+
+async def check(storage: Storage, nb_pages_per_site: int) -> bool:
+    logger.info(f"Writing {nb_pages_per_site} front pages per site..")
+    pages = list(synthetic_pages(nb_pages_per_site))
+    for idx in range(0, len(pages), 500):
+        await storage.add_pages(pages[idx : idx + 500])
+
+    async with storage.backend.get_connection() as conn:
+        await conn.execute("ANALYZE")
+
+    [site, *_] = await storage.list_sites()
+    middle = datetime(2024, 1, 1, tzinfo=ZoneInfo("UTC")) + timedelta(
+        hours=6 * (nb_pages_per_site // 2)
+    )
+    read_calls = {
+        "list_existing_frontpages": lambda: storage.list_existing_frontpages(
+            [site["name"]], middle - timedelta(days=30), middle
+        ),
+        "find_frontpage_by_digest": lambda: storage.find_frontpage_by_digest(
+            site["name"], f"DIGEST{nb_pages_per_site // 2}"
+        ),
+        "list_sites": lambda: storage.list_sites(),
+        "list_neighbouring_main_articles": lambda: (
+            storage.list_neighbouring_main_articles(site["id"], middle)
+        ),
+        "list_neighbouring_main_articles (latest)": lambda: (
+            storage.list_neighbouring_main_articles(site["id"])
+        ),
+        "iter_titles_without_embedding": lambda: anext(
+            storage.iter_titles_without_embedding(), None
+        ),
+        "load_embeddings": lambda: storage.load_embeddings(),
+        "list_articles_on_frontpage": lambda: storage.list_articles_on_frontpage(
+            [1, 2, 3]
+        ),
+    }
+
+    explaining = ExplainingBackend(storage.backend)
+    storage.backend = explaining
+
+    success = True
+    for name, call in read_calls.items():
+        explaining.plans.clear()
+        await call()
+
+        scans = [s for (_, plan) in explaining.plans for s in full_scans(plan)]
+        if scans and name.split(" ")[0] not in allowed_full_scans:
+            logger.error(f"{name} scans whole tables : {scans}")
+            success = False
+        else:
+            logger.info(f"{name} : OK")
+
+    storage.backend = explaining.backend
+    return success
+
+
+async def check_backend(backend, nb_pages_per_site: int) -> bool:
+    storage = Storage(backend)
+    await storage._create_db()
+
+    try:
+        return await check(storage, nb_pages_per_site)
+    finally:
+        await storage.close()
+
+
+async def check_query_plans(
+    nb_pages_per_site: int, postgres_url: str | None = None
+) -> bool:
+    if postgres_url is None:
+        with tempfile.TemporaryDirectory(prefix="media_observer") as tmp_dir:
+            backend = await SqliteBackend.create(str(Path(tmp_dir) / "plans.db"))
+            return await check_backend(backend, nb_pages_per_site)
+
+    # Tables are created in a schema of their own, that is dropped afterwards
+    schema = f"query_plans_{os.getpid()}"
+    conn = await asyncpg.connect(postgres_url)
+    try:
+        await conn.execute(f"CREATE SCHEMA {schema}")
+        pool = await asyncpg.create_pool(
+            postgres_url, server_settings={"search_path": schema}
+        )
+        return await check_backend(PostgresBackend(pool), nb_pages_per_site)
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await conn.close()
+
+
+async def main(nb_pages_per_site: int, postgres_url: str | None):
+    if not await check_query_plans(nb_pages_per_site, postgres_url):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the read queries are served by indexes"
+    )
+    parser.add_argument(
+        "nb_pages_per_site",
+        nargs="?",
+        type=int,
+        default=2000,
+        help="Number of synthetic front pages written for each site",
+    )
+    parser.add_argument(
+        "--postgres",
+        metavar="URL",
+        help="Run the check on a PostgreSQL database (in a temporary schema) instead of SQLite",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(args.nb_pages_per_site, args.postgres))
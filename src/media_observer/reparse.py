@@ -0,0 +1,113 @@
+import asyncio
+import argparse
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from loguru import logger
+
+from media_observer.internet_archive import InternetArchiveSnapshot
+from media_observer.medias import media_collection
+from media_observer.snapshot_archive import SnapshotArchive
+from media_observer.storage import Storage
+from config import settings
+
+
+# Front pages are parsed again from the snapshots of the archive, without any
+# access to the network, and the stored front pages are replaced by the new
+# results : this allows applying a fix in a parser to pages that were already
+# stored.
+
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
+
+def parse_in_process(site: str, snapshot: InternetArchiveSnapshot):
+    # Parsing is CPU-bound, hence it is done in a pool of processes ; the soup
+    # can not be sent back to the main process, and is of no use to the storage
+    cls = media_collection[site].FrontPageClass
+    soup = cls.parse_html(snapshot)
+    return cls(snapshot, None, cls.get_top_articles(soup), cls.get_main_article(soup))
+
+
+async def parse(executor: Executor, site: str, snapshot: InternetArchiveSnapshot, dt):
+    loop = asyncio.get_event_loop()
+    try:
+        page = await loop.run_in_executor(executor, parse_in_process, site, snapshot)
+        return media_collection[site], page, dt
+    except Exception as e:
+        logger.error(f"Could not parse snapshot from {snapshot.id.url} : {e!r}")
+        return None
+
+
+async def store(storage: Storage, pages: list) -> int:
+    try:
+        await storage.add_pages(pages, replace=True)
+        return len(pages)
+    except Exception as e:
+        # A single faulty page should not prevent the others from being
+        # stored, so they are stored one by one.
+        logger.warning(
+            f"Could not store a batch of {len(pages)} front pages ({e!r}), "
+            "falling back to one page at a time"
+        )
+
+    nb_stored = 0
+    for collection, page, dt in pages:
+        try:
+            await storage.add_pages([(collection, page, dt)], replace=True)
+            nb_stored += 1
+        except Exception as e:
+            logger.error(
+                f"Could not store front page from {page.snapshot.id.url} : {e!r}"
+            )
+    return nb_stored
+
+
+async def reparse(
+    storage: Storage, archive: SnapshotArchive, executor: Executor, site: str | None
+):
+    logger.info(f"Parsing {archive.count(site)} archived snapshots again..")
+    nb_stored = nb_failed = 0
+
+    # Snapshots are read, parsed and stored in batches, so that only a few of
+    # them are held in memory at a time
+    for batch in batched(archive.iter_snapshots(site), 100):
+        results = await asyncio.gather(
+            *[parse(executor, *snapshot) for snapshot in batch]
+        )
+        pages = [r for r in results if r is not None]
+
+        nb_batch_stored = await store(storage, pages)
+        nb_stored += nb_batch_stored
+        nb_failed += len(results) - nb_batch_stored
+        logger.info(f"{nb_stored} front pages stored, {nb_failed} failures so far")
+
+
+async def main(site: str | None):
+    storage = await Storage.create()
+    archive = SnapshotArchive(Path(settings.snapshot_archive.file_path))
+    executor = ProcessPoolExecutor(settings.snapshot_archive.reparse_concurrency)
+
+    try:
+        await reparse(storage, archive, executor, site)
+    finally:
+        executor.shutdown()
+        archive.close()
+        await storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Parse the archived snapshots again and store the results"
+    )
+    parser.add_argument(
+        "--site",
+        choices=list(media_collection.keys()),
+        help="Only parse the snapshots of this site",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(args.site))
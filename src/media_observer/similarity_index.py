@@ -22,8 +22,8 @@ class SimilaritySearch:
     instance: ClassVar[Any | None] = None
 
     async def add_embeddings(self):
-        embeds = await self.storage.list_all_embeddings()
-        if not embeds:
+        title_ids, vectors = await self.storage.load_embeddings()
+        if len(title_ids) == 0:
             msg = (
                 "Did not find any embeddings in storage. "
                 "A plausible cause is that they have not been computed yet"
@@ -31,10 +31,10 @@ class SimilaritySearch:
             logger.error(msg)
             raise ValueError(msg)
 
-        for idx, e in enumerate(embeds):
-            self.index.add_item(idx, e["vector"])
-            self.title_to_index_id[e["title_id"]] = idx
-            self.index_id_to_title[idx] = e["title_id"]
+        for idx, (title_id, vector) in enumerate(zip(title_ids.tolist(), vectors)):
+            self.index.add_item(idx, vector)
+            self.title_to_index_id[title_id] = idx
+            self.index_id_to_title[idx] = title_id
 
         self.index.build(20)
 
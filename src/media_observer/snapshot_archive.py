@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+from loguru import logger
+
+from media_observer.internet_archive import (
+    InternetArchiveSnapshot,
+    InternetArchiveSnapshotId,
+    tz_utc,
+)
+
+
+class SnapshotArchive:
+    # The raw HTML of every snapshot is kept compressed in a SQLite file, once
+    # per distinct content (addressed by its SHA-256 digest), and indexed by
+    # site and by (virtual) timestamp so that front pages can be parsed again
+    # without fetching them from the Internet Archive.
+    #
+    # Snapshots are compressed and written in a thread of their own, so that
+    # the event loop is not blocked meanwhile (and writes do not overlap).
+    def __init__(self, file_path: Path) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.conn = sqlite3.connect(
+            file_path, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS contents (
+                digest TEXT PRIMARY KEY,
+                body BLOB NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                site TEXT NOT NULL,
+                timestamp_virtual TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                original TEXT NOT NULL,
+                digest TEXT NOT NULL REFERENCES contents (digest),
+                raw BOOLEAN NOT NULL,
+                PRIMARY KEY (site, timestamp_virtual)
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS snapshots_idx_site_timestamp ON snapshots (site, timestamp)"
+        )
+
+    async def add(self, site: str, snapshot: InternetArchiveSnapshot, dt: datetime):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._add, site, snapshot, dt)
+
+    def _add(self, site: str, snapshot: InternetArchiveSnapshot, dt: datetime):
+        body = snapshot.text.encode()
+        digest = hashlib.sha256(body).hexdigest()
+
+        self.conn.execute("BEGIN")
+        self.conn.execute(
+            "INSERT OR IGNORE INTO contents VALUES (?, ?)",
+            (digest, zlib.compress(body)),
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                site,
+                dt.isoformat(),
+                snapshot.id.timestamp.isoformat(),
+                snapshot.id.original,
+                digest,
+                snapshot.raw,
+            ),
+        )
+        self.conn.execute("COMMIT")
+
+    async def add_copy(
+        self,
+        site: str,
+        snapshot_id: InternetArchiveSnapshotId,
+        dt: datetime,
+        source_timestamp: datetime,
+    ):
+        # `snapshot_id` has the same content as the snapshot taken at
+        # `source_timestamp`, whose content is referenced instead
+        loop = asyncio.get_event_loop()
+        nb_rows = await loop.run_in_executor(
+            self.executor,
+            self._add_copy,
+            site,
+            snapshot_id,
+            dt,
+            source_timestamp,
+        )
+
+        if nb_rows == 0:
+            logger.warning(
+                f"No archived snapshot of {site} @ {source_timestamp} : the snapshot "
+                f"{snapshot_id.url} can not be archived for {dt}"
+            )
+
+    def _add_copy(
+        self,
+        site: str,
+        snapshot_id: InternetArchiveSnapshotId,
+        dt: datetime,
+        source_timestamp: datetime,
+    ) -> int:
+        cursor = self.conn.execute(
+            """
+            INSERT OR REPLACE INTO snapshots
+            SELECT site, ?, ?, ?, digest, raw
+            FROM snapshots
+            WHERE site = ? AND timestamp = ?
+            LIMIT 1
+            """,
+            (
+                dt.isoformat(),
+                snapshot_id.timestamp.isoformat(),
+                snapshot_id.original,
+                site,
+                source_timestamp.astimezone(tz_utc).isoformat(),
+            ),
+        )
+        return cursor.rowcount
+
+    def count(self, site: str | None = None) -> int:
+        [(count,)] = self.conn.execute(
+            "SELECT COUNT(*) FROM snapshots WHERE ?1 IS NULL OR site = ?1", (site,)
+        ).fetchall()
+        return count
+
+    def iter_snapshots(
+        self, site: str | None = None
+    ) -> Iterator[tuple[str, InternetArchiveSnapshot, datetime]]:
+        # Contents are decompressed one at a time, as they are iterated over
+        rows = self.conn.execute(
+            """
+            SELECT s.site, s.timestamp_virtual, s.timestamp, s.original, s.raw, c.body
+            FROM snapshots s
+            JOIN contents c ON c.digest = s.digest
+            WHERE ?1 IS NULL OR s.site = ?1
+            ORDER BY s.site, s.timestamp_virtual
+            """,
+            (site,),
+        )
+
+        for site_, timestamp_virtual, timestamp, original, raw, body in rows:
+            snapshot_id = InternetArchiveSnapshotId(
+                datetime.fromisoformat(timestamp), original
+            )
+            snapshot = InternetArchiveSnapshot(
+                snapshot_id, zlib.decompress(body).decode(), bool(raw)
+            )
+            yield site_, snapshot, datetime.fromisoformat(timestamp_virtual)
+
+    def close(self):
+        self.executor.shutdown()
+        self.conn.close()
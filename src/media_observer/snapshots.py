@@ -1,39 +1,61 @@
 import asyncio
-import sys
+import argparse
+import socket
 from uuid import uuid1
-import pickle
 import traceback
 import os
-import tempfile
-import urllib.parse
 from pathlib import Path
 from datetime import date, datetime, time, timedelta
 from zoneinfo import ZoneInfo
-from attrs import frozen
+from aiohttp import ClientConnectionError, ClientPayloadError
+from attrs import evolve, field, frozen
 from loguru import logger
 
 
 from media_observer.article import ArchiveCollection, FrontPage
 from media_observer.internet_archive import (
+    CircuitOpenError,
     InternetArchiveClient,
     InternetArchiveSnapshot,
     InternetArchiveSnapshotId,
     SnapshotNotYetAvailable,
+    TransientResponseError,
 )
 from media_observer.medias import media_collection
 from media_observer.storage import Storage
-from media_observer.worker import Job, Worker, JobQueue
+from media_observer.snapshot_archive import SnapshotArchive
+from media_observer.worker import (
+    DeadLetterStore,
+    Job,
+    JobPostponed,
+    JobQueue,
+    RetryPolicy,
+    Worker,
+    BatchWorker,
+    PersistentJobQueue,
+    PostgresJobQueue,
+    Supervisor,
+    WorkerPool,
+)
+from media_observer.db.postgres import PostgresBackend
 from config import settings
 
 
-tmpdir = Path(tempfile.mkdtemp(prefix="media_observer"))
-idx = 0
+# Network errors, and some error responses from the Internet Archive (429 and 5xx),
+# are usually short-lived : other 4xx responses (e.g. 404) are not retried
+transient_errors_policy = RetryPolicy(**settings.retry.transient_error)
 
 
 def unique_id():
     return uuid1()
 
 
+def postponed(e: CircuitOpenError) -> JobPostponed:
+    # Jobs wait for the circuit to close again, without using up their attempts
+    delay = (e.open_until - datetime.now(ZoneInfo("UTC"))).total_seconds()
+    return JobPostponed(max(delay, 0), str(e))
+
+
 @frozen
 class SnapshotSearchJob(Job):
     collection: ArchiveCollection
@@ -63,6 +85,20 @@ class SnapshotSearchJob(Job):
             < now
         ]
 
+    @staticmethod
+    def next_at_hours(hours: list[int], tz: ZoneInfo, after: datetime) -> datetime:
+        day = after.astimezone(tz).date()
+
+        return min(
+            dt
+            for i in range(0, 2)
+            for h in hours
+            if (
+                dt := datetime.combine(day + timedelta(days=i), time(hour=h), tzinfo=tz)
+            )
+            > after
+        )
+
 
 @frozen
 class SnapshotFetchJob(Job):
@@ -87,17 +123,22 @@ class SnapshotStoreJob(Job):
 
 @frozen
 class SearchWorker(Worker):
-    storage: Storage
     ia_client: InternetArchiveClient
+    storage: Storage
+    archive: SnapshotArchive
     type_ = SnapshotSearchJob
+    retry_policies = {
+        SnapshotNotYetAvailable: RetryPolicy(**settings.retry.not_yet_available),
+        ClientConnectionError: transient_errors_policy,
+        ClientPayloadError: transient_errors_policy,
+        TransientResponseError: transient_errors_policy,
+        TimeoutError: transient_errors_policy,
+    }
 
     async def execute(self, job: SnapshotSearchJob):
         collection = job.collection
         dt = job.dt
 
-        if await self.storage.exists_frontpage(collection.name, dt):
-            return None, []
-
         self._log(
             "DEBUG", job, f"Start handling snap for collection {collection.name} @ {dt}"
         )
@@ -117,10 +158,16 @@ class SearchWorker(Worker):
                     f"Snapshot is {abs(delta)} {time} the required timestamp ({id_closest.timestamp} instead of {job.dt})",
                 )
 
+            if await self.copy_stored_frontpage(job, id_closest):
+                return id_closest, []
+
             return id_closest, [
                 SnapshotFetchJob(job.id_, id_closest, job.collection, job.dt)
             ]
 
+        except CircuitOpenError as e:
+            raise postponed(e) from e
+
         except SnapshotNotYetAvailable as e:
             self._log(
                 "WARNING",
@@ -138,16 +185,50 @@ class SearchWorker(Worker):
             traceback.print_exception(e)
             raise e
 
+    async def copy_stored_frontpage(
+        self, job: SnapshotSearchJob, snap_id: InternetArchiveSnapshotId
+    ) -> bool:
+        # Front pages often stay the same for hours (e.g. overnight) : when the
+        # content of the snapshot was already parsed for that site, the stored
+        # front page is copied, without fetching nor parsing it again.
+        if snap_id.digest is None:
+            return False
+
+        stored = await self.storage.find_frontpage_by_digest(
+            job.collection.name, snap_id.digest
+        )
+        if stored is None:
+            return False
+
+        await self.storage.copy_frontpage(stored["id"], snap_id, job.dt)
+        await self.archive.add_copy(
+            job.collection.name, snap_id, job.dt, stored["timestamp"]
+        )
+        self._log(
+            "DEBUG",
+            job,
+            f"Same content as the front page @ {stored['timestamp_virtual']}, copied",
+        )
+        return True
+
 
 @frozen
 class FetchWorker(Worker):
     ia_client: InternetArchiveClient
     type_ = SnapshotFetchJob
+    retry_policies = {
+        ClientConnectionError: transient_errors_policy,
+        ClientPayloadError: transient_errors_policy,
+        TransientResponseError: transient_errors_policy,
+        TimeoutError: transient_errors_policy,
+    }
 
     async def execute(self, job: SnapshotFetchJob):
         try:
             closest = await self.ia_client.fetch(job.snap_id)
             return closest, [SnapshotParseJob(job.id_, job.collection, closest, job.dt)]
+        except CircuitOpenError as e:
+            raise postponed(e) from e
         except Exception as e:
             self._log("ERROR", job, f"Error while fetching {job.snap_id}")
             traceback.print_exception(e)
@@ -156,44 +237,57 @@ class FetchWorker(Worker):
 
 @frozen
 class ParseWorker(Worker):
+    archive: SnapshotArchive
     type_ = SnapshotParseJob
+    # Parsings in progress, by (snapshot id, raw)
+    parsings: dict = field(factory=dict, init=False, eq=False)
 
     async def execute(self, job: SnapshotParseJob):
-        try:
-            main_page = await job.collection.FrontPageClass.from_snapshot(job.snapshot)
-            return main_page, [
-                SnapshotStoreJob(job.id_, main_page, job.collection, job.dt)
-            ]
-        except Exception as e:
-            snapshot = job.snapshot
-            sub_dir = (
-                tmpdir
-                / urllib.parse.quote_plus(snapshot.id.original)
-                / urllib.parse.quote_plus(str(snapshot.id.timestamp))
+        # Snapshots are archived before being parsed, so that they can be parsed
+        # again later on (e.g. after a fix in the parser), whatever the outcome
+        await self.archive.add(job.collection.name, job.snapshot, job.dt)
+
+        main_page = await self.parse(job)
+        # The soup is of no use once the page is parsed, and would only
+        # weigh on the queue
+        stored_page = evolve(main_page, soup=None)
+        return main_page, [
+            SnapshotStoreJob(job.id_, stored_page, job.collection, job.dt)
+        ]
+
+    async def parse(self, job: SnapshotParseJob) -> FrontPage:
+        # The same snapshot is often found for several virtual timestamps : the
+        # jobs that parse it at the same time share a single parsing. Parsed
+        # pages are not kept any longer (they hold the whole HTML tree), the
+        # snapshots found later on are copied from the stored front page
+        # instead (see `SearchWorker.copy_stored_frontpage`).
+        key = (job.snapshot.id, job.snapshot.raw)
+
+        if (task := self.parsings.get(key)) is None:
+            task = asyncio.ensure_future(
+                job.collection.FrontPageClass.from_snapshot(job.snapshot)
             )
-            os.makedirs(sub_dir)
+            task.add_done_callback(lambda _: self.parsings.pop(key, None))
+            self.parsings[key] = task
 
-            with open(sub_dir / "job.pickle", "wb") as f:
-                pickle.dump(job, f)
-            with open(sub_dir / "snapshot.html", "w") as f:
-                f.write(snapshot.text)
-            with open(sub_dir / "exception.txt", "w") as f:
-                f.writelines(traceback.format_exception(e))
-            with open(sub_dir / "url.txt", "w") as f:
-                f.write(snapshot.id.url)
+        return await asyncio.shield(task)
 
-            self._log(
-                "ERROR",
-                job,
-                f"Error while parsing snapshot from {snapshot.id.url}, details were written in directory {sub_dir}",
-            )
-            raise e
+    def dead_letter_attachments(self, job: SnapshotParseJob) -> dict[str, str]:
+        return {"snapshot.html": job.snapshot.text, "url.txt": job.snapshot.id.url}
 
 
 @frozen
-class StoreWorker(Worker):
+class StoreWorker(BatchWorker):
     storage: Storage
     type_ = SnapshotStoreJob
+    batch_size = settings.snapshots.store_batch_size
+    batch_timeout = settings.snapshots.store_batch_timeout
+
+    async def execute_batch(self, jobs: list[SnapshotStoreJob]):
+        return (
+            await self.storage.add_pages([(j.collection, j.page, j.dt) for j in jobs]),
+            [],
+        )
 
     async def execute(self, job: SnapshotStoreJob):
         try:
@@ -208,62 +302,221 @@ class StoreWorker(Worker):
             raise e
 
 
-async def main(jobs):
-    storage = await Storage.create()
+job_types = [
+    SnapshotSearchJob,
+    SnapshotFetchJob,
+    SnapshotParseJob,
+    SnapshotStoreJob,
+]
 
-    queue = JobQueue(
-        [
-            SnapshotSearchJob,
-            SnapshotFetchJob,
-            SnapshotParseJob,
-            SnapshotStoreJob,
-        ]
+# Each role runs the workers of a single stage : this allows spreading the
+# stages over several processes (or machines) that share the same job queue.
+roles = {
+    "search": SnapshotSearchJob,
+    "fetch": SnapshotFetchJob,
+    "parse": SnapshotParseJob,
+    "store": SnapshotStoreJob,
+}
+
+
+def most_recent_first(job: Job) -> float:
+    return -job.dt.timestamp()
+
+
+def by_site(job: Job) -> str:
+    return job.collection.name
+
+
+def by_frontpage(job: Job) -> tuple[str, datetime]:
+    # Whatever their stage, jobs are about a single front page
+    return job.collection.name, job.dt
+
+
+async def create_queue(storage: Storage, role: str) -> JobQueue:
+    # Fresh snapshots are handled first, and all sites make progress at the
+    # same pace whatever the order in which their jobs were created.
+    scheduling = dict(
+        priority=most_recent_first, fairness_key=by_site, key=by_frontpage
     )
+    dead_letters = DeadLetterStore(Path(settings.retry.dead_letters_dir))
+
+    if role == "all":
+        max_sizes = {
+            roles[r]: max_size
+            for r, max_size in settings.snapshots.queue_max_sizes.items()
+        }
+        return PersistentJobQueue(
+            job_types,
+            Path(settings.snapshots.queue_file_path),
+            max_sizes=max_sizes,
+            dead_letters=dead_letters,
+            **scheduling,
+        )
+
+    if not isinstance(storage.backend, PostgresBackend):
+        raise ValueError(
+            f'The "{role}" role requires a PostgreSQL database, so that jobs can be '
+            "shared with the processes running the other roles"
+        )
+
+    return await PostgresJobQueue.create(
+        job_types,
+        storage.backend,
+        f"{socket.gethostname()}:{os.getpid()}",
+        lease_duration=timedelta(seconds=settings.job_queue.lease_duration),
+        heartbeat_interval=settings.job_queue.heartbeat_interval,
+        poll_interval=settings.job_queue.poll_interval,
+        dead_letters=dead_letters,
+        **scheduling,
+    )
+
+
+async def without_stored_frontpages(storage: Storage, jobs: list[Job]) -> list[Job]:
+    # Search jobs for front pages that are already stored are dropped, using
+    # a single query for all of them
+    search_jobs = [j for j in jobs if isinstance(j, SnapshotSearchJob)]
+    if not search_jobs:
+        return jobs
+
+    stored = await storage.list_existing_frontpages(
+        list({j.collection.name for j in search_jobs}),
+        min(j.dt for j in search_jobs),
+        max(j.dt for j in search_jobs),
+    )
+    missing = [
+        j
+        for j in jobs
+        if not isinstance(j, SnapshotSearchJob)
+        or (j.collection.name, j.dt) not in stored
+    ]
+    logger.info(
+        f"{len(jobs) - len(missing)} of the {len(search_jobs)} front pages to search for are already stored"
+    )
+
+    return missing
 
-    logger.info("Starting snapshot service..")
 
-    for j in jobs:
-        queue.put_nowait(j)
+async def schedule_searches(queue: JobQueue, hours: list[int]):
+    # Emits the search job of each collection as soon as each of `hours` has
+    # passed in the timezone of that collection
+    now = datetime.now(ZoneInfo("UTC"))
+    next_dts = {
+        name: SnapshotSearchJob.next_at_hours(hours, c.tz, now)
+        for name, c in media_collection.items()
+    }
 
+    while True:
+        name, dt = min(next_dts.items(), key=lambda item: item[1])
+        delay = (dt - datetime.now(ZoneInfo("UTC"))).total_seconds()
+        await asyncio.sleep(max(delay, 0))
+
+        collection = media_collection[name]
+        logger.info(f"Scheduling snapshot search for {name} @ {dt}")
+        await queue.put(SnapshotSearchJob(unique_id(), collection, dt))
+        next_dts[name] = SnapshotSearchJob.next_at_hours(hours, collection.tz, dt)
+
+
+async def main(jobs, role: str = "all", daemon: bool = False, replayed: bool = False):
+    storage = await Storage.create()
+    queue = await create_queue(storage, role)
+    archive = SnapshotArchive(Path(settings.snapshot_archive.file_path))
+
+    logger.info(f'Starting snapshot service with role "{role}"..')
+
+    # Replayed jobs may belong to any stage : they are seeded whatever the
+    # role, the other stages being handled by their own processes
+    if role in ["all", "search"] or replayed:
+        await queue.seed(await without_stored_frontpages(storage, jobs))
+
+    try:
+        await run(queue, storage, archive, role, daemon)
+    finally:
+        logger.debug(f"Storage id cache stats : {storage.id_cache_stats}")
+        archive.close()
+        await queue.close()
+        await storage.close()
+        logger.info("Snapshot service exiting")
+
+
+async def run(
+    queue: JobQueue,
+    storage: Storage,
+    archive: SnapshotArchive,
+    role: str,
+    daemon: bool,
+):
     async with InternetArchiveClient.create() as ia:
-        workers = {
-            SearchWorker(queue, storage, ia): 3,
-            FetchWorker(queue, ia): 3,
-            ParseWorker(queue): 3,
-            StoreWorker(queue, storage): 1,
-        }
+        workers = [
+            SearchWorker(queue, ia, storage, archive),
+            FetchWorker(queue, ia),
+            ParseWorker(queue, archive),
+            StoreWorker(queue, storage),
+        ]
+        if role != "all":
+            workers = [w for w in workers if w.type_ == roles[role]]
+
+        pools = [
+            WorkerPool(w, bounds.min, bounds.max)
+            for w in workers
+            for r, bounds in settings.autoscaling.workers.items()
+            if w.type_ == roles[r]
+        ]
+        supervisor = Supervisor(
+            queue,
+            pools,
+            settings.autoscaling.interval,
+            settings.autoscaling.target_drain_time,
+        )
 
         async with asyncio.TaskGroup() as tg:
-            tasks = []
-            for w, nb in workers.items():
-                for _ in range(nb):
-                    tasks.append(tg.create_task(w.loop()))
+            supervisor_task = tg.create_task(supervisor.run())
 
-            # Wait until the queue is fully processed.
-            await queue.join()
+            if daemon:
+                # Workers are kept running (until the process is interrupted),
+                # waiting for the jobs of the next scheduled searches.
+                if role in ["all", "search"]:
+                    tg.create_task(schedule_searches(queue, settings.snapshots.hours))
+                await supervisor_task
+            else:
+                # Wait until the queue is fully processed.
+                await queue.join()
 
-            for t in tasks:
-                t.cancel()
+                supervisor_task.cancel()
 
-    await storage.close()
-    logger.info("Snapshot service exiting")
 
+async def replay(root_dir: Path, role: str):
+    # Replayed jobs are given a fresh set of attempts
+    jobs = [evolve(j, attempt=0) for j in DeadLetterStore(root_dir).jobs()]
+    logger.info(f"Replaying {len(jobs)} jobs from {root_dir}")
 
-async def replay(root_dir: Path):
-    jobs = []
-    for pickled_job in root_dir.glob("**/**/*.pickle"):
-        with open(pickled_job, "rb") as f:
-            jobs.append(pickle.load(f))
-
-    await main(jobs)
+    await main(jobs, role, replayed=True)
 
 
 if __name__ == "__main__":
-    try:
-        path = Path(sys.argv[1])
-        asyncio.run(replay(path))
-    except IndexError:
+    parser = argparse.ArgumentParser(description="Snapshot service")
+    parser.add_argument(
+        "replay_dir",
+        nargs="?",
+        type=Path,
+        help="Directory of dead letters (jobs that failed for good) to run again",
+    )
+    parser.add_argument(
+        "--role",
+        choices=["all", *roles.keys()],
+        default="all",
+        help="Only run the workers of one stage (requires a PostgreSQL database)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and look for new snapshots as each of the configured hours passes",
+    )
+    args = parser.parse_args()
+
+    if args.replay_dir is not None:
+        asyncio.run(replay(args.replay_dir, args.role))
+    else:
         jobs = SnapshotSearchJob.create(
             settings.snapshots.days_in_past, settings.snapshots.hours
         )
-        asyncio.run(main(jobs))
+        asyncio.run(main(jobs, args.role, args.daemon))
@@ -1,6 +1,12 @@
+import asyncio
 from typing import Any
-from datetime import datetime
+from itertools import chain
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
 import numpy as np
+from numpy.typing import NDArray
+from attrs import define, field
+from loguru import logger
 from yarl import URL
 
 from config import settings
@@ -15,12 +21,16 @@ from media_observer.storage_abstraction import (
     ColumnType,
     Column,
     UniqueIndex,
+    Index,
     View,
     StorageAbc,
 )
 from media_observer.db.sqlite import SqliteBackend
 from media_observer.db.postgres import PostgresBackend
-from media_observer.internet_archive import InternetArchiveSnapshotId
+from media_observer.internet_archive import (
+    InternetArchiveSnapshotId,
+    timestamp_to_str,
+)
 
 
 table_sites = Table(
@@ -45,6 +55,23 @@ table_frontpages = Table(
         Column(name="url_snapshot", type_=ColumnType.Url),
     ],
 )
+# The digest (as given by the CDX API) of the snapshot of each front page : a
+# capture with the same digest has the same content, and its front page can be
+# copied from the stored one instead of being fetched and parsed again.
+table_frontpage_digests = Table(
+    name="frontpage_digests",
+    columns=[
+        Column(
+            name="frontpage_id",
+            references=Reference("frontpages", "id", on_delete="cascade"),
+        ),
+        Column(
+            name="site_id",
+            references=Reference("sites", "id", on_delete="cascade"),
+        ),
+        Column(name="digest", type_=ColumnType.Text),
+    ],
+)
 table_articles = Table(
     name="articles",
     columns=[
@@ -134,108 +161,144 @@ view_frontpages = View(
             sites AS si ON si.id = fp.site_id
         """,
 )
-view_articles = View(
-    name="articles_view",
-    column_names=[
-        "id",
-        "title",
-        "title_id",
-        "url_archive",
-        "url_article",
-        "main_in_frontpage_id",
-        "top_in_frontpage_id",
-        "rank",
-    ],
-    create_stmt="""
-        SELECT
-            a.id,
-            t.text AS title,
-            t.id AS title_id,
-            ma.url AS url_archive,
-            a.url AS url_article,
-            ma.frontpage_id AS main_in_frontpage_id,
-            NULL AS top_in_frontpage_id,
-            NULL AS rank
-        FROM articles a
-        JOIN main_articles ma ON ma.article_id = a.id
-        JOIN titles t ON t.id = ma.title_id
-
-        UNION ALL
-
-        SELECT
-            a.id,
-            t.text AS title,
-            t.id AS title_id,
-            ta.url AS url_archive,
-            a.url AS url_article,
-            NULL AS main_in_frontpage_id,
-            ta.frontpage_id AS top_in_frontpage_id,
-            ta.rank
-        FROM articles a
-        JOIN top_articles ta ON ta.article_id = a.id
-        JOIN titles t ON t.id = ta.title_id
-        """,
-)
-view_articles_on_frontpage = View(
-    name="articles_on_frontpage_view",
-    column_names=[
-        "frontpage_id",
-        "site_id",
-        "site_name",
-        "site_original_url",
-        "timestamp",
-        "timestamp_virtual",
-        "archive_snapshot_url",
-        "article_id",
-        "title",
-        "title_id",
-        "url_archive",
-        "url_article",
-        "is_main",
-        "rank",
+# A denormalized table of all articles that appeared on a front page, along with
+# the informations on the front page itself. It is written along with the base
+# tables (see `articles_on_frontpage_select`) and serves most read queries.
+table_articles_on_frontpage = Table(
+    name="articles_on_frontpage",
+    columns=[
+        Column(
+            name="frontpage_id",
+            references=Reference("frontpages", "id", on_delete="cascade"),
+        ),
+        Column(
+            name="site_id",
+            references=Reference("sites", "id", on_delete="cascade"),
+        ),
+        Column(name="site_name", type_=ColumnType.Text),
+        Column(name="site_original_url", type_=ColumnType.Url),
+        Column(name="timestamp", type_=ColumnType.TimestampTz),
+        Column(name="timestamp_virtual", type_=ColumnType.TimestampTz),
+        Column(name="archive_snapshot_url", type_=ColumnType.Url),
+        Column(
+            name="article_id",
+            references=Reference("articles", "id", on_delete="cascade"),
+        ),
+        Column(name="title", type_=ColumnType.Text),
+        Column(
+            name="title_id",
+            references=Reference("titles", "id", on_delete="cascade"),
+        ),
+        Column(name="url_archive", type_=ColumnType.Url),
+        Column(name="url_article", type_=ColumnType.Url),
+        Column(name="is_main", type_=ColumnType.Boolean),
+        Column(name="rank", type_=ColumnType.Integer),
     ],
-    create_stmt="""
-        SELECT
-            fpv.id AS frontpage_id,
-            fpv.site_id,
-            fpv.site_name,
-            fpv.site_original_url,
-            fpv."timestamp",
-            fpv.timestamp_virtual,
-            fpv.archive_snapshot_url,
-            av.id AS article_id,
-            av.title,
-            av.title_id,
-            av.url_archive,
-            av.url_article,
-            av.main_in_frontpage_id IS NOT NULL AS is_main,
-            av.rank
-        FROM articles_view av
-        JOIN frontpages_view fpv ON fpv.id = av.main_in_frontpage_id OR fpv.id = av.top_in_frontpage_id
-    """,
 )
+# Computes the rows of `articles_on_frontpage` from the base tables, for the
+# front pages that match the `{where}` clause.
+articles_on_frontpage_select = """
+    SELECT
+        fp.id AS frontpage_id,
+        si.id AS site_id,
+        si.name AS site_name,
+        si.original_url AS site_original_url,
+        fp."timestamp",
+        fp.timestamp_virtual,
+        fp.url_snapshot AS archive_snapshot_url,
+        a.id AS article_id,
+        t.text AS title,
+        t.id AS title_id,
+        ma.url AS url_archive,
+        a.url AS url_article,
+        TRUE AS is_main,
+        NULL AS rank
+    FROM main_articles ma
+    JOIN frontpages fp ON fp.id = ma.frontpage_id
+    JOIN sites si ON si.id = fp.site_id
+    JOIN articles a ON a.id = ma.article_id
+    JOIN titles t ON t.id = ma.title_id
+    WHERE {where}
+
+    UNION ALL
+
+    SELECT
+        fp.id AS frontpage_id,
+        si.id AS site_id,
+        si.name AS site_name,
+        si.original_url AS site_original_url,
+        fp."timestamp",
+        fp.timestamp_virtual,
+        fp.url_snapshot AS archive_snapshot_url,
+        a.id AS article_id,
+        t.text AS title,
+        t.id AS title_id,
+        ta.url AS url_archive,
+        a.url AS url_article,
+        FALSE AS is_main,
+        ta.rank
+    FROM top_articles ta
+    JOIN frontpages fp ON fp.id = ta.frontpage_id
+    JOIN sites si ON si.id = fp.site_id
+    JOIN articles a ON a.id = ta.article_id
+    JOIN titles t ON t.id = ta.title_id
+    WHERE {where}
+"""
+
+
+@define
+class IdCache:
+    """A bounded LRU map from natural keys (e.g. an article's URL) to database ids"""
+
+    max_size: int
+    hits: int = 0
+    misses: int = 0
+    _ids: OrderedDict = field(factory=OrderedDict)
+
+    def get(self, key) -> int | None:
+        try:
+            self._ids.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self._ids[key]
+
+    def update(self, ids: dict[Any, int]):
+        for key, id_ in ids.items():
+            self._ids[key] = id_
+            self._ids.move_to_end(key)
+
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._ids)}
 
 
 class Storage(StorageAbc):
     tables = [
         table_sites,
         table_frontpages,
+        table_frontpage_digests,
         table_articles,
         table_titles,
         table_main_articles,
         table_top_articles,
         table_embeddings,
+        table_articles_on_frontpage,
     ]
 
     views = [
         view_frontpages,
-        view_articles,
-        view_articles_on_frontpage,
     ]
 
     indexes = [
         UniqueIndex(table="sites", columns=["name"]),
         UniqueIndex(table="frontpages", columns=["timestamp_virtual", "site_id"]),
+        UniqueIndex(table="frontpage_digests", columns=["frontpage_id"]),
         UniqueIndex(table="articles", columns=["url"]),
         UniqueIndex(table="titles", columns=["text"]),
         UniqueIndex(table="main_articles", columns=["frontpage_id", "article_id"]),
@@ -243,10 +306,27 @@ class Storage(StorageAbc):
             table="top_articles", columns=["frontpage_id", "article_id", "rank"]
         ),
         UniqueIndex(table="embeddings", columns=["title_id"]),
+        Index(table="frontpages", columns=["site_id", "timestamp_virtual"]),
+        Index(table="frontpage_digests", columns=["site_id", "digest"]),
+        Index(table="main_articles", columns=["title_id"]),
+        Index(table="top_articles", columns=["title_id"]),
+        Index(table="articles_on_frontpage", columns=["frontpage_id"]),
+        Index(table="articles_on_frontpage", columns=["title_id"]),
+        Index(
+            table="articles_on_frontpage",
+            columns=["site_id", "timestamp_virtual"],
+            where="is_main",
+        ),
+        Index(table="articles_on_frontpage", columns=["timestamp_virtual", "is_main"]),
     ]
 
+    cached_tables = ["sites", "articles", "titles"]
+
     def __init__(self, backend):
         self.backend = backend
+        self.id_caches = {
+            t: IdCache(settings.storage.id_cache_size) for t in self.cached_tables
+        }
 
     async def close(self):
         await self.backend.close()
@@ -283,20 +363,50 @@ class Storage(StorageAbc):
             for v in self.views:
                 await v.create_if_not_exists(conn)
 
-    async def exists_frontpage(self, name: str, dt: datetime):
-        async with self.backend.get_connection() as conn:
-            exists = await conn.execute_fetchall(
-                """
-                    SELECT 1
+    async def list_existing_frontpages(
+        self, names: list[str], start: datetime, end: datetime
+    ) -> set[tuple[str, datetime]]:
+        # All the (site name, virtual timestamp) pairs of the front pages of
+        # those sites that were stored between `start` and `end` (inclusive)
+        async with self.backend.get_connection(readonly=True) as conn:
+            rows = await conn.execute_fetchall(
+                f"""
+                    SELECT s.name, f.timestamp_virtual
                     FROM frontpages f
                     JOIN sites s ON s.id = f.site_id
-                    WHERE s.name = $1 AND timestamp_virtual = $2
+                    WHERE
+                        s.name IN ({self._placeholders(*names, offset=2)})
+                        AND f.timestamp_virtual BETWEEN $1 AND $2
+                """,
+                start,
+                end,
+                *names,
+            )
+
+        return {(name, timestamp_virtual) for name, timestamp_virtual in rows}
+
+    async def find_frontpage_by_digest(self, name: str, digest: str):
+        # The most recent front page of that site whose snapshot has `digest`
+        async with self.backend.get_connection(readonly=True) as conn:
+            rows = await conn.execute_fetchall(
+                """
+                    SELECT f.*
+                    FROM frontpage_digests d
+                    JOIN sites s ON s.id = d.site_id
+                    JOIN frontpages f ON f.id = d.frontpage_id
+                    WHERE s.name = $1 AND d.digest = $2
+                    ORDER BY d.frontpage_id DESC
+                    LIMIT 1
                 """,
                 name,
-                dt,
+                digest,
             )
 
-        return exists != []
+        if not rows:
+            return None
+
+        [row] = rows
+        return self._from_row(row, self._table_by_name["frontpages"])
 
     @classmethod
     def _from_row(cls, r, table_or_view: Table | View):
@@ -309,12 +419,12 @@ class Storage(StorageAbc):
         site_id: int,
         timestamp: datetime | None = None,
     ):
-        async with self.backend.get_connection() as conn:
+        async with self.backend.get_connection(readonly=True) as conn:
             if timestamp is None:
                 [row] = await conn.execute_fetchall(
                     """
                     SELECT timestamp_virtual
-                    FROM frontpages_view
+                    FROM frontpages
                     WHERE site_id = $1
                     ORDER BY timestamp_virtual DESC
                     LIMIT 1
@@ -322,150 +432,357 @@ class Storage(StorageAbc):
                     site_id,
                 )
                 timestamp = row["timestamp_virtual"]
+            elif timestamp.tzinfo is None:
+                # Consistent with asyncpg that interprets naive datetimes as UTC
+                timestamp = timestamp.replace(tzinfo=timezone.utc)
 
             # This query is the union of 3 queries that respectively fetch :
             #   * articles published at the same time as the queried article (including the queried article)
             #   * the article published just after, on the same site
-            #   *the article published just before, on the same site
+            #   * the article published just before, on the same site
+            # All of them are expressed as range predicates on `timestamp_virtual`, so that
+            # they are served by the indexes on articles_on_frontpage instead of a full scan.
             main_articles = await conn.execute_fetchall(
                 """
-                WITH aof_diff AS (
-                    SELECT aof.*, EXTRACT(EPOCH FROM aof.timestamp_virtual - $2) :: integer AS time_diff
-                    FROM articles_on_frontpage_view aof
-                )
                 SELECT * FROM (
-                    SELECT * FROM aof_diff
-                    WHERE is_main AND time_diff = 0
-                )
+                    SELECT * FROM articles_on_frontpage
+                    WHERE timestamp_virtual = $2 AND is_main
+                ) AS aof_simultaneous
                 UNION ALL
                 SELECT * FROM (
-                    SELECT * FROM aof_diff
-                    WHERE is_main AND site_id = $1 AND time_diff > 0
-                    ORDER BY time_diff
+                    SELECT * FROM articles_on_frontpage
+                    WHERE site_id = $1 AND timestamp_virtual > $2 AND is_main
+                    ORDER BY timestamp_virtual
                     LIMIT 1
-                )
+                ) AS aof_after
                 UNION ALL
                 SELECT * FROM (
-                    SELECT * FROM aof_diff
-                    WHERE is_main AND site_id = $1 AND time_diff < 0
-                    ORDER BY time_diff DESC
+                    SELECT * FROM articles_on_frontpage
+                    WHERE site_id = $1 AND timestamp_virtual < $2 AND is_main
+                    ORDER BY timestamp_virtual DESC
                     LIMIT 1
-                )
+                ) AS aof_before
                 """,
                 site_id,
                 timestamp,
             )
 
-            return [
-                self._from_row(a, self._view_by_name["articles_on_frontpage_view"])
-                | {"time_diff": a[14]}
-                for a in main_articles
-            ]
+            def with_time_diff(row):
+                a = self._from_row(row, self._table_by_name["articles_on_frontpage"])
+                delta = a["timestamp_virtual"] - timestamp
+                return a | {"time_diff": int(delta.total_seconds())}
 
-    async def list_all_titles_without_embedding(self):
-        async with self.backend.get_connection() as conn:
-            rows = await conn.execute_fetchall("""
-                SELECT t.*
-                FROM public.titles AS t
-                WHERE NOT EXISTS (SELECT 1 FROM embeddings WHERE title_id = t.id)
-            """)
+            return [with_time_diff(r) for r in main_articles]
 
-            return [self._from_row(r, self._table_by_name["titles"]) for r in rows]
+    async def iter_titles_without_embedding(self, page_size: int = 1000):
+        # Titles are paginated by id, and the connection is released between
+        # pages so that embeddings can be written while iterating.
+        last_id = 0
 
-    async def list_all_embeddings(self):
-        async with self.backend.get_connection() as conn:
-            rows = await conn.execute_fetchall(
-                """
-                    SELECT *
-                    FROM embeddings
-                """,
-            )
+        while True:
+            async with self.backend.get_connection(readonly=True) as conn:
+                rows = await conn.execute_fetchall(
+                    """
+                        SELECT t.*
+                        FROM titles AS t
+                        WHERE
+                            t.id > $1
+                            AND NOT EXISTS (SELECT 1 FROM embeddings WHERE title_id = t.id)
+                        ORDER BY t.id
+                        LIMIT $2
+                    """,
+                    last_id,
+                    page_size,
+                )
+
+            if len(rows) == 0:
+                return
+
+            for r in rows:
+                yield self._from_row(r, self._table_by_name["titles"])
 
-            return [self._from_embeddings_row(r) for r in rows]
+            last_id = rows[-1][0]
+
+    async def load_embeddings(
+        self, chunk_size: int = 10_000
+    ) -> tuple[NDArray[np.int64], NDArray[np.float32]]:
+        """
+        Load all embeddings as an array of title ids and a `(n, d)` matrix
+        whose rows are the matching embeddings.
+
+        Rows are read in chunks (paginated by id) and copied straight into the
+        preallocated arrays, so that the memory used is close to the size of
+        the matrix itself.
+        """
+        async with self.backend.get_connection(readonly=True) as conn:
+            async with conn.transaction():
+                [(nb_rows,)] = await conn.execute_fetchall(
+                    "SELECT COUNT(*) FROM embeddings"
+                )
+                title_ids = np.empty(nb_rows, dtype=np.int64)
+                vectors = None
+                nb_loaded = 0
+                last_id = 0
+
+                while nb_loaded < nb_rows:
+                    rows = await conn.execute_fetchall(
+                        """
+                            SELECT id, title_id, vector
+                            FROM embeddings
+                            WHERE id > $1
+                            ORDER BY id
+                            LIMIT $2
+                        """,
+                        last_id,
+                        min(chunk_size, nb_rows - nb_loaded),
+                    )
+                    if len(rows) == 0:
+                        break
+
+                    chunk = np.frombuffer(
+                        b"".join(r[2] for r in rows), dtype=np.float32
+                    ).reshape(len(rows), -1)
+                    if vectors is None:
+                        vectors = np.empty((nb_rows, chunk.shape[1]), dtype=np.float32)
+
+                    title_ids[nb_loaded : nb_loaded + len(rows)] = [r[1] for r in rows]
+                    vectors[nb_loaded : nb_loaded + len(rows)] = chunk
+                    nb_loaded += len(rows)
+                    last_id = rows[-1][0]
+
+        if vectors is None:
+            vectors = np.empty((0, 0), dtype=np.float32)
+
+        return title_ids[:nb_loaded], vectors[:nb_loaded]
 
     async def list_articles_on_frontpage(self, title_ids: list[int]):
         if len(title_ids) == 0:
             return []
 
-        async with self.backend.get_connection() as conn:
+        async with self.backend.get_connection(readonly=True) as conn:
             rows = await conn.execute_fetchall(
                 f"""
                     SELECT *
-                    FROM articles_on_frontpage_view
+                    FROM articles_on_frontpage
                     WHERE title_id IN ({self._placeholders(*title_ids)})
                 """,
                 *title_ids,
             )
 
             return [
-                self._from_row(r, self._view_by_name["articles_on_frontpage_view"])
+                self._from_row(r, self._table_by_name["articles_on_frontpage"])
                 for r in rows
             ]
 
-    @classmethod
-    def _from_embeddings_row(cls, r):
-        [embeds_table] = [t for t in cls.tables if t.name == "embeddings"]
-        d = cls._from_row(r, embeds_table)
-        d.update(vector=np.frombuffer(d["vector"], dtype="float32"))
-
-        return d
-
     async def add_embedding(self, title_id: int, embedding):
+        await self.add_embeddings({title_id: embedding})
+
+    async def add_embeddings(self, embeddings_by_title_id: dict[int, NDArray]):
+        # The whole batch is sent at once, with vectors as raw float32 bytes
         async with self.backend.get_connection() as conn:
-            await conn.execute_insert(
-                self._insert_stmt(
-                    "embeddings",
-                    ["title_id", "vector"],
-                ),
-                title_id,
-                embedding,
-            )
+            async with conn.transaction():
+                await conn.execute_many(
+                    self._insert_stmt("embeddings", ["title_id", "vector"]),
+                    [
+                        (title_id, np.asarray(e, dtype=np.float32).tobytes())
+                        for title_id, e in embeddings_by_title_id.items()
+                    ],
+                )
 
     async def list_sites(self):
-        async with self.backend.get_connection() as conn:
+        async with self.backend.get_connection(readonly=True) as conn:
             sites = await conn.execute_fetchall("SELECT * FROM sites")
             return [self._from_row(s, self._table_by_name["sites"]) for s in sites]
 
     async def add_page(
         self, collection: ArchiveCollection, page: FrontPage, dt: datetime
     ):
+        [site_id] = await self.add_pages([(collection, page, dt)])
+        return site_id
+
+    async def add_pages(
+        self,
+        pages: list[tuple[ArchiveCollection, FrontPage, datetime]],
+        replace: bool = False,
+    ):
+        # With `replace`, the articles of front pages that were already stored
+        # are replaced by the ones of `pages` (e.g. once they are parsed again).
+
+        # Ids that are found or created during the transaction are staged there
+        staged_ids = defaultdict(dict)
+
+        # All pages are written within a single transaction
+        async with self.backend.get_connection() as conn:
+            async with conn.transaction():
+                site_ids = [
+                    await self._add_page(
+                        conn, staged_ids, collection, page, dt, replace
+                    )
+                    for (collection, page, dt) in pages
+                ]
+
+        # .. and they only end up in the cache once the transaction is committed,
+        # so that a rollback can not leave ids of non-existing rows in there.
+        for table, ids in staged_ids.items():
+            self.id_caches[table].update(ids)
+
+        return site_ids
+
+    async def copy_frontpage(
+        self, frontpage_id: int, snapshot: InternetArchiveSnapshotId, dt: datetime
+    ) -> int:
+        # The front page `frontpage_id` is stored again at `dt`, as found in
+        # `snapshot` (a capture with the same content), with the same articles
         assert dt.tzinfo is not None
 
         async with self.backend.get_connection() as conn:
             async with conn.transaction():
-                site_id = await self._add_site(conn, collection.name, collection.url)
-                frontpage_id = await self._add_frontpage(
-                    conn, site_id, page.snapshot.id, dt
-                )
-                article_id = await self._add_article(
-                    conn, page.main_article.article.original
-                )
-                title_id = await self._add_title(conn, page.main_article.article.title)
-                await self._add_main_article(
-                    conn,
+                [(site_id, timestamp)] = await conn.execute_fetchall(
+                    'SELECT site_id, "timestamp" FROM frontpages WHERE id = $1',
                     frontpage_id,
-                    article_id,
-                    title_id,
-                    page.main_article.article.url,
                 )
-
-                for t in page.top_articles:
-                    article_id = await self._add_article(conn, t.article.original)
-                    title_id = await self._add_title(conn, t.article.title)
-                    await self._add_top_article(
-                        conn, frontpage_id, article_id, title_id, t.article.url, t.rank
+                new_id = await self._add_frontpage(conn, site_id, snapshot, dt)
+                await self._add_frontpage_digest(conn, new_id, site_id, snapshot.digest)
+
+                # Links to the articles point to the Wayback Machine at the time
+                # of the snapshot : only the "/web/<timestamp>/" part of their
+                # path is changed, whatever their scheme or host.
+                old_segment = self._wayback_segment(timestamp)
+                new_segment = self._wayback_segment(snapshot.timestamp)
+                for table, cols in [
+                    ("main_articles", "article_id, title_id"),
+                    ("top_articles", "article_id, title_id, rank"),
+                ]:
+                    await conn.execute(
+                        f"""
+                            INSERT INTO {table} (frontpage_id, url, {cols})
+                            SELECT $1, REPLACE(url, $2, $3), {cols}
+                            FROM {table}
+                            WHERE frontpage_id = $4
+                            ON CONFLICT DO NOTHING
+                        """,
+                        new_id,
+                        old_segment,
+                        new_segment,
+                        frontpage_id,
                     )
+                await self._refresh_articles_on_frontpage(conn, new_id)
 
         return site_id
 
-    async def _add_site(self, conn, name: str, original_url: str) -> int:
-        return await self._insert_or_get(
+    @staticmethod
+    def _wayback_segment(timestamp: datetime) -> str:
+        return f"/web/{timestamp_to_str(timestamp.astimezone(timezone.utc))}/"
+
+    @property
+    def id_cache_stats(self):
+        return {t: c.stats for t, c in self.id_caches.items()}
+
+    async def _add_page(
+        self,
+        conn,
+        staged_ids: dict,
+        collection: ArchiveCollection,
+        page: FrontPage,
+        dt: datetime,
+        replace: bool = False,
+    ) -> int:
+        assert dt.tzinfo is not None
+
+        site_id = await self._add_site(
+            conn, staged_ids, collection.name, collection.url
+        )
+        frontpage_id = await self._add_frontpage(conn, site_id, page.snapshot.id, dt)
+        await self._add_frontpage_digest(
+            conn, frontpage_id, site_id, page.snapshot.id.digest
+        )
+        if replace:
+            await self._delete_page_articles(conn, frontpage_id)
+        await self._add_page_articles(conn, staged_ids, frontpage_id, page)
+        await self._refresh_articles_on_frontpage(conn, frontpage_id)
+
+        return site_id
+
+    async def _add_page_articles(
+        self, conn, staged_ids: dict, frontpage_id: int, page: FrontPage
+    ):
+        # All the articles and titles of the page are upserted at once, so that
+        # the number of statements sent does not depend on the size of the page.
+        main = page.main_article.article
+        snapshots = [main] + [t.article for t in page.top_articles]
+
+        article_ids = await self._add_articles(
+            conn, staged_ids, [s.original for s in snapshots]
+        )
+        title_ids = await self._add_titles(
+            conn, staged_ids, [s.title for s in snapshots]
+        )
+
+        await self._add_main_article(
+            conn,
+            frontpage_id,
+            article_ids[str(main.original.url)],
+            title_ids[main.title],
+            main.url,
+        )
+        await self._add_top_articles(
+            conn,
+            frontpage_id,
+            [
+                (
+                    article_ids[str(t.article.original.url)],
+                    title_ids[t.article.title],
+                    t.article.url,
+                    t.rank,
+                )
+                for t in page.top_articles
+            ],
+        )
+
+    async def _delete_page_articles(self, conn, frontpage_id: int):
+        for table in ["main_articles", "top_articles"]:
+            await conn.execute(
+                f"DELETE FROM {table} WHERE frontpage_id = $1", frontpage_id
+            )
+
+    async def _refresh_articles_on_frontpage(self, conn, frontpage_id: int):
+        await conn.execute(
+            "DELETE FROM articles_on_frontpage WHERE frontpage_id = $1", frontpage_id
+        )
+        await conn.execute(
+            self._insert_articles_on_frontpage_stmt("fp.id = $1"), frontpage_id
+        )
+
+    async def rebuild_articles_on_frontpage(self):
+        async with self.backend.get_connection() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM articles_on_frontpage")
+                await conn.execute(self._insert_articles_on_frontpage_stmt("TRUE"))
+
+    @staticmethod
+    def _insert_articles_on_frontpage_stmt(where: str):
+        cols_str = ", ".join(table_articles_on_frontpage.column_names)
+        return f"""
+            INSERT INTO articles_on_frontpage ({cols_str})
+            {articles_on_frontpage_select.format(where=where)}
+        """
+
+    async def _add_site(
+        self, conn, staged_ids: dict, name: str, original_url: str
+    ) -> int:
+        if (site_id := self._get_cached_id(staged_ids, "sites", name)) is not None:
+            return site_id
+
+        site_id = await self._insert_or_get(
             conn,
             self._insert_stmt("sites", ["name", "original_url"]),
             [name, original_url],
             "SELECT id FROM sites WHERE name = $1",
             [name],
         )
+        staged_ids["sites"][name] = site_id
+
+        return site_id
 
     async def _add_frontpage(
         self, conn, site_id: int, snapshot: InternetArchiveSnapshotId, virtual: datetime
@@ -487,22 +804,34 @@ class Storage(StorageAbc):
             [virtual, site_id],
         )
 
-    async def _add_article(self, conn, article: Article):
-        return await self._insert_or_get(
-            conn,
-            self._insert_stmt("articles", ["url"]),
-            [str(article.url)],
-            "SELECT id FROM articles WHERE url = $1",
-            [str(article.url)],
+    async def _add_frontpage_digest(
+        self, conn, frontpage_id: int, site_id: int, digest: str | None
+    ):
+        # Snapshots that were not found through the CDX API have no digest
+        if digest is None:
+            return
+
+        await conn.execute_insert(
+            self._insert_stmt(
+                "frontpage_digests", ["frontpage_id", "site_id", "digest"]
+            ),
+            frontpage_id,
+            site_id,
+            digest,
         )
 
-    async def _add_title(self, conn, title: str):
-        return await self._insert_or_get(
-            conn,
-            self._insert_stmt("titles", ["text"]),
-            [title],
-            "SELECT id FROM titles WHERE text = $1",
-            [title],
+    async def _add_articles(
+        self, conn, staged_ids: dict, articles: list[Article]
+    ) -> dict[str, int]:
+        return await self._insert_many_or_get_cached(
+            conn, staged_ids, "articles", "url", [str(a.url) for a in articles]
+        )
+
+    async def _add_titles(
+        self, conn, staged_ids: dict, titles: list[str]
+    ) -> dict[str, int]:
+        return await self._insert_many_or_get_cached(
+            conn, staged_ids, "titles", "text", titles
         )
 
     async def _add_main_article(
@@ -518,25 +847,25 @@ class Storage(StorageAbc):
             str(url),
         )
 
-    async def _add_top_article(
+    async def _add_top_articles(
         self,
         conn,
         frontpage_id: int,
-        article_id: int,
-        title_id: int,
-        url: URL,
-        rank: int,
+        top_articles: list[tuple[int, int, URL, int]],
     ):
+        if len(top_articles) == 0:
+            return
+
         await conn.execute_insert(
             self._insert_stmt(
                 "top_articles",
                 ["frontpage_id", "article_id", "title_id", "url", "rank"],
+                nb_rows=len(top_articles),
+            ),
+            *chain.from_iterable(
+                (frontpage_id, article_id, title_id, str(url), rank)
+                for (article_id, title_id, url, rank) in top_articles
             ),
-            frontpage_id,
-            article_id,
-            title_id,
-            str(url),
-            rank,
         )
 
     async def _insert_or_get(
@@ -553,18 +882,66 @@ class Storage(StorageAbc):
 
         return id_
 
+    def _get_cached_id(self, staged_ids: dict, table: str, key) -> int | None:
+        if (id_ := staged_ids[table].get(key)) is not None:
+            return id_
+
+        return self.id_caches[table].get(key)
+
+    async def _insert_many_or_get_cached(
+        self, conn, staged_ids: dict, table: str, key_column: str, keys: list[Any]
+    ) -> dict[Any, int]:
+        ids = {}
+        missing_keys = []
+        for key in dict.fromkeys(keys):
+            if (id_ := self._get_cached_id(staged_ids, table, key)) is not None:
+                ids[key] = id_
+            else:
+                missing_keys.append(key)
+
+        new_ids = await self._insert_many_or_get(conn, table, key_column, missing_keys)
+        staged_ids[table].update(new_ids)
+
+        return ids | new_ids
+
+    async def _insert_many_or_get(
+        self, conn, table: str, key_column: str, keys: list[Any]
+    ) -> dict[Any, int]:
+        unique_keys = list(dict.fromkeys(keys))
+        if len(unique_keys) == 0:
+            return {}
+
+        await conn.execute_insert(
+            self._insert_stmt(table, [key_column], nb_rows=len(unique_keys)),
+            *unique_keys,
+        )
+        rows = await conn.execute_fetchall(
+            f"""
+                SELECT {key_column}, id
+                FROM {table}
+                WHERE {key_column} IN ({self._placeholders(*unique_keys)})
+            """,
+            *unique_keys,
+        )
+
+        return {key: id_ for (key, id_) in rows}
+
     @staticmethod
-    def _insert_stmt(table, cols):
+    def _insert_stmt(table, cols, nb_rows=1):
         cols_str = ", ".join(cols)
+        values = ", ".join(
+            f"({Storage._placeholders(*cols, offset=row * len(cols))})"
+            for row in range(nb_rows)
+        )
         return f"""
             INSERT INTO {table} ({cols_str})
-            VALUES ({Storage._placeholders(*cols)})
+            VALUES {values}
             ON CONFLICT DO NOTHING
         """
 
     @staticmethod
-    def _placeholders(*args):
-        return ", ".join([f"${idx + 1}" for idx, _ in enumerate(args)])
+    def _placeholders(*args, offset=0):
+        return ", ".join([f"${offset + idx + 1}" for idx, _ in enumerate(args)])
 
     @property
     def _table_by_name(self):
@@ -573,3 +950,16 @@ class Storage(StorageAbc):
     @property
     def _view_by_name(self):
         return {v.name: v for v in self.views}
+
+
+async def main():
+    storage = await Storage.create()
+
+    logger.info("Rebuilding table articles_on_frontpage..")
+    await storage.rebuild_articles_on_frontpage()
+    await storage.close()
+    logger.info("Table articles_on_frontpage rebuilt")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
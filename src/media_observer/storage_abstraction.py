@@ -1,27 +1,52 @@
 from abc import ABC
 from enum import Enum, auto
 from datetime import datetime
-from attrs import frozen
+from typing import ClassVar
+from attrs import frozen, field
 
 
 @frozen
-class UniqueIndex:
+class Index:
     table: str
     columns: list[str]
+    # An optional SQL condition, that makes it a partial index
+    where: str | None = None
+    # Columns that are stored in the index without being part of the key, so that
+    # it covers more queries. This is only supported by PostgreSQL and ignored on
+    # other backends.
+    include: list[str] = field(factory=list)
+    kind: ClassVar[str] = "idx"
+    unique: ClassVar[bool] = False
 
     @property
     def name(self):
-        return f"{self.table}_unique_idx_{'_'.join(self.columns)}"
+        suffix = "_partial" if self.where is not None else ""
+        return f"{self.table}_{self.kind}_{'_'.join(self.columns)}{suffix}"
 
     async def create_if_not_exists(self, conn):
         cols = ",".join(self.columns)
+        unique = "UNIQUE" if self.unique else ""
+        include = (
+            f"INCLUDE ({','.join(self.include)})"
+            if self.include and conn.dialect == "postgresql"
+            else ""
+        )
+        where = f"WHERE {self.where}" if self.where is not None else ""
         stmt = f"""
-            CREATE UNIQUE INDEX IF NOT EXISTS {self.name}
+            CREATE {unique} INDEX IF NOT EXISTS {self.name}
             ON {self.table} ({cols})
+            {include}
+            {where}
         """
         await conn.execute(stmt)
 
 
+@frozen
+class UniqueIndex(Index):
+    kind: ClassVar[str] = "unique_idx"
+    unique: ClassVar[bool] = True
+
+
 @frozen
 class Reference:
     table_name: str
@@ -41,6 +66,7 @@ class ColumnType(Enum):
     Url = "TEXT"
     TimestampTz = "timestamp with time zone"
     Integer = "INTEGER"
+    Boolean = "BOOLEAN"
     Vector = "bytea"
 
 
@@ -51,10 +77,15 @@ class Column:
     primary_key: bool = False
     references: Reference | None = None
 
-    @property
-    def attrs(self):
+    def attrs(self, dialect: str):
         if self.primary_key:
-            return ColumnType.PrimaryKey.value
+            # SQLite has no SERIAL type, but an INTEGER PRIMARY KEY is an alias
+            # to the auto-incremented rowid
+            return (
+                "INTEGER PRIMARY KEY"
+                if dialect == "sqlite"
+                else ColumnType.PrimaryKey.value
+            )
         elif self.references is not None:
             return f"{ColumnType.Integer.value} {ColumnType.References.value} {self.references.as_sql}"
         elif self.type_ is not None:
@@ -73,7 +104,7 @@ class Table:
         return [c.name for c in self.columns]
 
     async def create_if_not_exists(self, conn):
-        cols = ",\n".join([f"{c.name} {c.attrs}" for c in self.columns])
+        cols = ",\n".join([f"{c.name} {c.attrs(conn.dialect)}" for c in self.columns])
         await conn.execute(f"""
                 CREATE TABLE IF NOT EXISTS {self.name} (
                     {cols}
@@ -88,8 +119,15 @@ class View:
     column_names: list[str]
 
     async def create_if_not_exists(self, conn):
+        if conn.dialect == "sqlite":
+            # SQLite does not support "CREATE OR REPLACE VIEW"
+            await conn.execute(f"DROP VIEW IF EXISTS {self.name}")
+            create = "CREATE VIEW"
+        else:
+            create = "CREATE OR REPLACE VIEW"
+
         stmt = f"""
-        CREATE OR REPLACE VIEW {self.name} AS
+        {create} {self.name} AS
         {self.create_stmt}
         """
         await conn.execute(stmt)
@@ -106,7 +144,12 @@ class StorageAbc(ABC):
     async def create():
         raise NotImplementedError()
 
-    async def exists_frontpage(self, name: str, dt: datetime):
+    async def list_existing_frontpages(
+        self, names: list[str], start: datetime, end: datetime
+    ):
+        raise NotImplementedError()
+
+    async def find_frontpage_by_digest(self, name: str, digest: str):
         raise NotImplementedError()
 
     async def list_articles_on_frontpage(self, title_ids: list[int]):
@@ -115,6 +158,9 @@ class StorageAbc(ABC):
     async def add_embedding(self, title_id: int, embedding):
         raise NotImplementedError()
 
+    async def add_embeddings(self, embeddings_by_title_id):
+        raise NotImplementedError()
+
     async def list_sites(self):
         raise NotImplementedError()
 
@@ -127,3 +173,9 @@ class StorageAbc(ABC):
 
     async def add_page(self, collection, page, dt):
         raise NotImplementedError()
+
+    async def add_pages(self, pages, replace=False):
+        raise NotImplementedError()
+
+    async def copy_frontpage(self, frontpage_id, snapshot, dt):
+        raise NotImplementedError()
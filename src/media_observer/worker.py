@@ -1,27 +1,230 @@
 import asyncio
+import heapq
+import itertools
+import os
+import pickle
+import random
+import sqlite3
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from datetime import timedelta
 from uuid import UUID
-from attrs import frozen
+from attrs import define, evolve, field, frozen
 from loguru import logger
 from abc import ABC, abstractmethod
-from typing import Any, ClassVar
+from collections import deque
+from typing import Any, Callable, ClassVar, Hashable
 
 
 @frozen
 class Job(ABC):
     id_: UUID
+    # Number of previous attempts at handling this job, that failed
+    attempt: int = field(default=0, kw_only=True)
+
+
+class JobPostponed(Exception):
+    # Raised while handling a job that can not be handled before `delay`
+    # seconds (e.g. a remote service asked to wait) : the job is put back in
+    # the queue, without counting as a failed attempt.
+    def __init__(self, delay: float, *args) -> None:
+        super().__init__(*args)
+        self.delay = delay
+
+
+@frozen
+class RetryPolicy:
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+
+    def delay(self, attempt: int) -> float:
+        # Exponential backoff with jitter, so that jobs that failed together
+        # are not all retried at the same time
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class DeadLetterStore:
+    # Jobs that failed for good are written in `root_dir`, one directory per
+    # job, along with the exception that was raised and any file that helps
+    # understanding the failure. They can be inspected, and loaded again with
+    # `jobs`.
+    def __init__(self, root_dir: Path) -> None:
+        self.root_dir = root_dir
+
+    def add(self, job: Job, exc: Exception, attachments: dict[str, str]) -> Path:
+        sub_dir = self.root_dir / type(job).__name__ / str(job.id_)
+        os.makedirs(sub_dir, exist_ok=True)
+
+        with open(sub_dir / "job.pickle", "wb") as f:
+            pickle.dump(job, f)
+        with open(sub_dir / "exception.txt", "w") as f:
+            f.writelines(traceback.format_exception(exc))
+        for file_name, content in attachments.items():
+            with open(sub_dir / file_name, "w") as f:
+                f.write(content)
+
+        return sub_dir
+
+    def jobs(self) -> list[Job]:
+        jobs = []
+        for pickled_job in self.root_dir.glob("**/*.pickle"):
+            with open(pickled_job, "rb") as f:
+                jobs.append(pickle.load(f))
+
+        return jobs
+
+
+class FairHeap:
+    # Items are split into groups (given by `fairness_key`) that are served in
+    # turn, and within a group the items with the lowest `priority` come first.
+    # Items with the same priority are served in insertion order.
+    def __init__(
+        self,
+        priority: Callable[[Any], float],
+        fairness_key: Callable[[Any], Hashable],
+    ) -> None:
+        self.priority = priority
+        self.fairness_key = fairness_key
+        self._heaps = {}
+        self._turns = deque()
+        self._counter = itertools.count()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, item):
+        key = self.fairness_key(item)
+        heap = self._heaps.setdefault(key, [])
+        if not heap:
+            self._turns.append(key)
+
+        heapq.heappush(heap, (self.priority(item), next(self._counter), item))
+        self._size += 1
+
+    def pop(self):
+        key = self._turns.popleft()
+        heap = self._heaps[key]
+        _, _, item = heapq.heappop(heap)
+
+        if heap:
+            self._turns.append(key)
+        else:
+            del self._heaps[key]
+
+        self._size -= 1
+        return item
+
+
+class FairPriorityQueue(asyncio.Queue):
+    # An asyncio.Queue that hands out its items in the order of a `FairHeap`,
+    # in the same way as asyncio.PriorityQueue does with a plain heap.
+    def __init__(
+        self,
+        priority: Callable[[Any], float],
+        fairness_key: Callable[[Any], Hashable],
+    ) -> None:
+        self.priority = priority
+        self.fairness_key = fairness_key
+        super().__init__()
+
+    def _init(self, maxsize):
+        self._queue = FairHeap(self.priority, self.fairness_key)
+
+    def _put(self, item):
+        self._queue.push(item)
+
+    def _get(self):
+        return self._queue.pop()
+
+
+def _no_priority(job: "Job") -> float:
+    return 0
+
+
+def _single_group(job: "Job") -> Hashable:
+    return None
+
+
+def _job_id(job: "Job") -> Hashable:
+    return job.id_
 
 
 class JobQueue:
-    def __init__(self, job_types) -> None:
+    # By default jobs are handed out in the order they were put, but a
+    # `priority` (lowest first) and a `fairness_key` (groups that are served in
+    # turn) can be provided to change this order.
+    #
+    # Jobs with the same `key` stand for the same piece of work : jobs that are
+    # seeded while an equivalent job is resumed from a previous run are skipped.
+    #
+    # The number of jobs waiting for each job type can be capped with
+    # `max_sizes` : `put` then waits until there is room in the queue, which
+    # slows down the workers that produce those jobs. Jobs put with
+    # `put_nowait` or `seed` are not subject to those limits.
+    def __init__(
+        self,
+        job_types,
+        priority: Callable[[Job], float] = _no_priority,
+        fairness_key: Callable[[Job], Hashable] = _single_group,
+        key: Callable[[Job], Hashable] = _job_id,
+        max_sizes: dict[type, int] | None = None,
+        dead_letters: DeadLetterStore | None = None,
+    ) -> None:
         self.job_types = job_types
+        self.priority = priority
+        self.fairness_key = fairness_key
+        self.key = key
+        self.max_sizes = max_sizes or {}
+        self.dead_letters = dead_letters
         self._finished = asyncio.locks.Event()
         self._pending_tasks = 0
-        self.queues = {kls: asyncio.Queue() for kls in self.job_types}
+        self.queues = {
+            kls: FairPriorityQueue(priority, fairness_key) for kls in self.job_types
+        }
+        self._not_full = {kls: asyncio.Condition() for kls in self.job_types}
 
     async def get(self, job_kls):
-        return await self.queues[job_kls].get()
+        [job] = await self._hand_out(job_kls, [await self.queues[job_kls].get()])
+        return job
+
+    async def get_batch(self, job_kls, max_size: int, timeout: float):
+        # Wait for at least one job, then gather whatever else arrives
+        # until either `max_size` jobs are collected or `timeout` expires.
+        queue = self.queues[job_kls]
+        batch = [await queue.get()]
+
+        try:
+            async with asyncio.timeout(timeout):
+                while len(batch) < max_size:
+                    batch.append(await queue.get())
+        except TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The jobs that were already taken must not be lost
+            for job in batch:
+                queue.put_nowait(job)
+            raise
 
-    def task_done(self, job_kls):
+        return await self._hand_out(job_kls, batch)
+
+    async def _hand_out(self, job_kls, jobs: list[Job]) -> list[Job]:
+        # Notifying the producers may suspend : the jobs must not be lost if
+        # the worker is cancelled meanwhile
+        try:
+            await self._notify_not_full(job_kls, len(jobs))
+        except asyncio.CancelledError:
+            for job in jobs:
+                self.queues[job_kls].put_nowait(job)
+            raise
+
+        return jobs
+
+    def task_done(self, job_kls, job: Job | None = None):
         self.queues[job_kls].task_done()
 
         self._pending_tasks -= 1
@@ -29,9 +232,63 @@ class JobQueue:
             self._finished.set()
 
     def put_nowait(self, job):
+        self._store(job)
+        self._enqueue(job)
+
+    async def put_later(self, job, delay: float):
+        self._store(job)
+
+        # The job is pending right away, so that `join` waits for it
+        self._pending_tasks += 1
+        self._finished.clear()
+        asyncio.get_running_loop().call_later(delay, self._put_delayed, job)
+
+    def _put_delayed(self, job):
+        self._pending_tasks -= 1
+        self._enqueue(job)
+
+    def _store(self, job):
+        # Jobs are only kept in memory
+        ...
+
+    def _enqueue(self, job):
         self._pending_tasks += 1
         self._finished.clear()
-        return self.queues[type(job)].put_nowait(job)
+        self.queues[type(job)].put_nowait(job)
+
+    def dead_letter(
+        self, job: Job, exc: Exception, attachments: dict[str, str]
+    ) -> Path | None:
+        if self.dead_letters is not None:
+            return self.dead_letters.add(job, exc, attachments)
+
+    async def put(self, job):
+        kls = type(job)
+        async with self._not_full[kls]:
+            await self._not_full[kls].wait_for(lambda: not self.full(kls))
+            return self.put_nowait(job)
+
+    def full(self, job_kls) -> bool:
+        max_size = self.max_sizes.get(job_kls, 0)
+        return max_size > 0 and self.queues[job_kls].qsize() >= max_size
+
+    async def _notify_not_full(self, job_kls, n: int):
+        async with self._not_full[job_kls]:
+            self._not_full[job_kls].notify(n)
+
+    async def release_backpressure(self):
+        # Once the workers are stopping, nothing makes room in the queues
+        # anymore : the limits are lifted so that the jobs being handled can
+        # still put the jobs that follow them.
+        self.max_sizes = {}
+        for not_full in self._not_full.values():
+            async with not_full:
+                not_full.notify_all()
+
+    async def seed(self, jobs: list[Job]):
+        # No worker is running yet to make room in the queues
+        for j in jobs:
+            self.put_nowait(j)
 
     async def join(self):
         if self._pending_tasks > 0:
@@ -40,34 +297,584 @@ class JobQueue:
     def qsize(self):
         return {j: self.queues[j].qsize() for j in self.job_types}
 
+    async def close(self): ...
+
+
+class PersistentJobQueue(JobQueue):
+    # All jobs are also written (pickled) in a SQLite file and only removed
+    # once they are done, so that a process that is restarted resumes the jobs
+    # that were not completed. Completions are written in batches of
+    # `flush_every`, hence a crash may lead to a few jobs being handled twice.
+    #
+    # Jobs are pickled and written in a thread of their own, so that the event
+    # loop is not blocked meanwhile : the ids of their rows are futures, that
+    # are always done by the time the rows are deleted (from the same thread).
+    def __init__(
+        self, job_types, file_path: Path, flush_every: int = 100, **kwargs
+    ) -> None:
+        super().__init__(job_types, **kwargs)
+        self.flush_every = flush_every
+        self._row_ids = {}
+        self._done_row_ids = []
+        self._resumed_keys = set()
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.conn = sqlite3.connect(
+            file_path, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                stage TEXT NOT NULL,
+                payload BLOB NOT NULL
+            )
+        """)
+
+        self.nb_resumed = self._resume()
+
+    def _resume(self) -> int:
+        kls_by_name = {kls.__name__: kls for kls in self.job_types}
+        nb_resumed = 0
+
+        for row_id, stage, payload in self.conn.execute(
+            "SELECT id, stage, payload FROM jobs ORDER BY id"
+        ):
+            try:
+                job = pickle.loads(payload)
+                assert isinstance(job, kls_by_name[stage])
+            except Exception as e:
+                logger.warning(f"Dropping stored job #{row_id} ({stage}) : {e!r}")
+                self._done_row_ids.append(self._known_row_id(row_id))
+                continue
+
+            self._row_ids[id(job)] = self._known_row_id(row_id)
+            self._resumed_keys.add(self.key(job))
+            self._enqueue(job)
+            nb_resumed += 1
+
+        self._flush()
+        return nb_resumed
+
+    @staticmethod
+    def _known_row_id(row_id: int) -> Future:
+        future = Future()
+        future.set_result(row_id)
+        return future
+
+    def _store(self, job):
+        self._row_ids[id(job)] = self._write(self._insert, job)
+
+    def _insert(self, job) -> int:
+        cursor = self.conn.execute(
+            "INSERT INTO jobs (stage, payload) VALUES (?, ?)",
+            (type(job).__name__, pickle.dumps(job)),
+        )
+        return cursor.lastrowid
+
+    def _delete(self, row_ids: list[Future]):
+        # Jobs that could not be inserted have no row to delete
+        self.conn.executemany(
+            "DELETE FROM jobs WHERE id = ?",
+            [(r.result(),) for r in row_ids if r.exception() is None],
+        )
+
+    def _write(self, fn, *args) -> Future:
+        def log_error(future: Future):
+            if (e := future.exception()) is not None:
+                logger.error(f"Could not write in the jobs file : {e!r}")
+
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(log_error)
+        return future
+
+    async def seed(self, jobs: list[Job]):
+        # Jobs left over by a previous run are handled along with the new ones,
+        # unless they stand for the same piece of work
+        new_jobs = [j for j in jobs if self.key(j) not in self._resumed_keys]
+        if self.nb_resumed > 0:
+            logger.info(
+                f"Resuming {self.nb_resumed} jobs left over by a previous run, "
+                f"along with {len(new_jobs)} new jobs "
+                f"({len(jobs) - len(new_jobs)} were already in the queue)"
+            )
+
+        await super().seed(new_jobs)
+
+    def task_done(self, job_kls, job: Job | None = None):
+        if job is not None:
+            self._done_row_ids.append(self._row_ids.pop(id(job)))
+
+        super().task_done(job_kls, job)
+
+        if len(self._done_row_ids) >= self.flush_every or self._pending_tasks == 0:
+            self._flush()
+
+    def _flush(self):
+        if self._done_row_ids:
+            self._write(self._delete, self._done_row_ids)
+            self._done_row_ids = []
+
+    async def close(self):
+        self._flush()
+        self.executor.shutdown()
+        self.conn.close()
+
+
+class PostgresJobQueue(JobQueue):
+    # Jobs are stored in a table of a PostgreSQL database that can be shared by
+    # several processes, possibly on several machines. Jobs are claimed with
+    # "SELECT .. FOR UPDATE SKIP LOCKED" and leased for `lease_duration` : the
+    # leases are extended every `heartbeat_interval` seconds for as long as the
+    # process is alive, and jobs whose lease expired can be claimed again by any
+    # process. Completed jobs are deleted on the next heartbeat.
+    #
+    # Jobs are claimed by order of priority, but the `fairness_key` is only
+    # honoured within a single process. As jobs are not held in memory, there
+    # is no limit on the number of waiting jobs.
+    #
+    # Jobs put with `put_nowait` are only written on the next heartbeat (or on
+    # `join` and `close`).
+    def __init__(
+        self,
+        job_types,
+        backend,
+        owner: str,
+        lease_duration: timedelta,
+        heartbeat_interval: float,
+        poll_interval: float,
+        **kwargs,
+    ) -> None:
+        super().__init__(job_types, **kwargs)
+        self.backend = backend
+        self.owner = owner
+        self.lease_duration = lease_duration
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self._leased_row_ids = {}
+        self._done_row_ids = []
+        self._new_jobs = []
+        self._sizes = {}
+        # Whether any job was ever found in the queue by this process
+        self._seen_jobs = False
+        self._heartbeat_task = None
+
+    @staticmethod
+    async def create(job_types, backend, owner: str, **kwargs):
+        queue = PostgresJobQueue(job_types, backend, owner, **kwargs)
+
+        async with backend.get_connection() as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    payload BYTEA NOT NULL,
+                    priority DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    lease_expires_at TIMESTAMP WITH TIME ZONE
+                )
+            """)
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_idx_stage_priority_id ON jobs (stage, priority, id)"
+            )
+
+        queue._heartbeat_task = asyncio.create_task(queue._heartbeat())
+        return queue
+
+    async def get(self, job_kls):
+        [job] = await self.get_batch(job_kls, 1, 0)
+        return job
+
+    async def get_batch(self, job_kls, max_size: int, timeout: float):
+        while True:
+            async with self.backend.get_connection() as conn:
+                rows = await conn.execute_fetchall(
+                    """
+                    UPDATE jobs
+                    SET owner = $2, lease_expires_at = now() + $3::interval
+                    WHERE id IN (
+                        SELECT id
+                        FROM jobs
+                        WHERE
+                            stage = $1
+                            AND (lease_expires_at IS NULL OR lease_expires_at < now())
+                        ORDER BY priority, id
+                        LIMIT $4
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, payload
+                    """,
+                    job_kls.__name__,
+                    self.owner,
+                    self.lease_duration,
+                    max_size,
+                )
+
+            if rows:
+                break
+
+            await asyncio.sleep(self.poll_interval)
+
+        jobs = []
+        for row_id, payload in rows:
+            job = pickle.loads(payload)
+            self._leased_row_ids[id(job)] = row_id
+            jobs.append(job)
+
+        # RETURNING does not keep the order of the subquery
+        return sorted(jobs, key=self.priority)
+
+    def put_nowait(self, job):
+        self._new_jobs.append(job)
+
+    async def put(self, job):
+        async with self.backend.get_connection() as conn:
+            await conn.execute(
+                "INSERT INTO jobs (stage, payload, priority) VALUES ($1, $2, $3)",
+                type(job).__name__,
+                pickle.dumps(job),
+                self.priority(job),
+            )
+
+    async def put_later(self, job, delay: float):
+        # The job cannot be claimed until its (fake) lease expires
+        async with self.backend.get_connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO jobs (stage, payload, priority, lease_expires_at)
+                VALUES ($1, $2, $3, now() + $4::interval)
+                """,
+                type(job).__name__,
+                pickle.dumps(job),
+                self.priority(job),
+                timedelta(seconds=delay),
+            )
+
+    async def seed(self, jobs: list[Job]):
+        async with self.backend.get_connection() as conn:
+            async with conn.transaction():
+                # Prevents several processes from seeding the queue at the same time
+                await conn.execute("LOCK TABLE jobs IN SHARE ROW EXCLUSIVE MODE")
+                rows = await conn.execute_fetchall("SELECT id, payload FROM jobs")
+
+                # Jobs already in the queue are handled along with the new
+                # ones, unless they stand for the same piece of work
+                present_keys = set()
+                for row_id, payload in rows:
+                    try:
+                        present_keys.add(self.key(pickle.loads(payload)))
+                    except Exception as e:
+                        logger.warning(f"Could not read stored job #{row_id} : {e!r}")
+
+                new_jobs = [j for j in jobs if self.key(j) not in present_keys]
+                self._seen_jobs = True
+                if rows:
+                    logger.info(
+                        f"Resuming {len(rows)} jobs already present in the queue, "
+                        f"along with {len(new_jobs)} new jobs "
+                        f"({len(jobs) - len(new_jobs)} were already in the queue)"
+                    )
+
+                await conn.execute_many(
+                    "INSERT INTO jobs (stage, payload, priority) VALUES ($1, $2, $3)",
+                    [
+                        (type(j).__name__, pickle.dumps(j), self.priority(j))
+                        for j in new_jobs
+                    ],
+                )
+
+    def task_done(self, job_kls, job: Job | None = None):
+        self._done_row_ids.append(self._leased_row_ids.pop(id(job)))
+
+    async def join(self):
+        # The queue is finished once no process has any job left to handle. A
+        # process that did not seed the queue may be started before the one
+        # that does : it waits until jobs show up.
+        await self._flush()
+        if not self._seen_jobs:
+            logger.info("Waiting for jobs to be put in the queue by another process..")
+
+        while True:
+            if self._seen_jobs and sum(self._sizes.values()) == 0:
+                return
+
+            await asyncio.sleep(self.poll_interval)
+            await self._flush()
+
+    def qsize(self):
+        return {j: self._sizes.get(j.__name__, 0) for j in self.job_types}
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.warning(f"Could not update the jobs table : {e!r}")
+
+    async def _flush(self):
+        done_row_ids = list(self._done_row_ids)
+        new_jobs = list(self._new_jobs)
+
+        async with self.backend.get_connection() as conn:
+            if new_jobs:
+                await conn.execute_many(
+                    "INSERT INTO jobs (stage, payload, priority) VALUES ($1, $2, $3)",
+                    [
+                        (type(j).__name__, pickle.dumps(j), self.priority(j))
+                        for j in new_jobs
+                    ],
+                )
+            await conn.execute(
+                "DELETE FROM jobs WHERE id = ANY($1::bigint[])", done_row_ids
+            )
+            await conn.execute(
+                """
+                UPDATE jobs
+                SET lease_expires_at = now() + $2::interval
+                WHERE id = ANY($1::bigint[]) AND owner = $3
+                """,
+                list(self._leased_row_ids.values()),
+                self.lease_duration,
+                self.owner,
+            )
+            sizes = await conn.execute_fetchall(
+                "SELECT stage, COUNT(*) FROM jobs GROUP BY stage"
+            )
+
+        self._done_row_ids = self._done_row_ids[len(done_row_ids) :]
+        self._new_jobs = self._new_jobs[len(new_jobs) :]
+        self._sizes = {stage: nb for stage, nb in sizes}
+        if sum(self._sizes.values()) > 0:
+            self._seen_jobs = True
+
+    async def close(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        await self._flush()
+
+
+async def run_to_completion(coro):
+    # Runs `coro` until it is done even if the calling task is cancelled
+    # meanwhile, in which case the cancellation is raised afterwards.
+    task = asyncio.ensure_future(coro)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await task
+        raise
+
+
+@define
+class MovingAverage:
+    # Exponentially weighted moving average
+    alpha: float = 0.2
+    value: float | None = None
+
+    def update(self, x: float):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value = self.alpha * x + (1 - self.alpha) * self.value
+
 
 @frozen
 class Worker(ABC):
     queue: JobQueue
     type_: ClassVar[type]
+    # Jobs that fail with one of those exceptions are retried later on, the
+    # others are sent to the dead letters of the queue
+    retry_policies: ClassVar[dict[type[Exception], RetryPolicy]] = {}
+    # Time (in seconds) spent in `execute` per job, regardless of the time
+    # spent waiting for jobs or for room in the next queue
+    latency: MovingAverage = field(factory=MovingAverage, kw_only=True, eq=False)
 
     @abstractmethod
     async def execute(self, job: Job) -> tuple[Any, list[Job]]: ...
 
     async def loop(self):
+        # The loop can be cancelled at any time : a job that was taken out of
+        # the queue is still handled before exiting.
         while True:
             # Get a "work item" out of the queue.
             job = await self.queue.get(self.type_)
 
-            assert isinstance(job, self.type_)
-
             try:
-                res, further_jobs = await self.execute(job)
+                await run_to_completion(self._handle(job))
+            finally:
+                self.queue.task_done(self.type_, job)
 
-                if res is not None:
-                    self._log("DEBUG", job, f"Completed job {job.__class__.__name__}")
+    async def _handle(self, job: Job):
+        assert isinstance(job, self.type_)
+
+        try:
+            start = time.monotonic()
+            res, further_jobs = await self.execute(job)
+            self.latency.update(time.monotonic() - start)
 
-                for j in further_jobs:
-                    self.queue.put_nowait(j)
-            except Exception:
-                ...
+            if res is not None:
+                self._log("DEBUG", job, f"Completed job {job.__class__.__name__}")
 
-            self.queue.task_done(self.type_)
+            for j in further_jobs:
+                await self.queue.put(j)
+        except JobPostponed as e:
+            self._log("DEBUG", job, f"Postponed by {e.delay:.0f}s : {e}")
+            # A new job is put, as the queue may keep track of the one being handled
+            await self.queue.put_later(evolve(job), e.delay)
+        except Exception as e:
+            await self._fail(job, e)
+
+    async def _fail(self, job: Job, exc: Exception):
+        policy = next(
+            (p for kls, p in self.retry_policies.items() if isinstance(exc, kls)),
+            None,
+        )
+        nb_attempts = job.attempt + 1
+
+        if policy is not None and nb_attempts < policy.max_attempts:
+            delay = policy.delay(job.attempt)
+            self._log(
+                "WARNING",
+                job,
+                f"Attempt {nb_attempts}/{policy.max_attempts} failed with {exc!r}, "
+                f"retrying in {delay:.0f}s",
+            )
+            await self.queue.put_later(evolve(job, attempt=nb_attempts), delay)
+        else:
+            path = self.queue.dead_letter(job, exc, self.dead_letter_attachments(job))
+            details = f", details were written in directory {path}" if path else ""
+            self._log(
+                "ERROR",
+                job,
+                f"Giving up on {job.__class__.__name__} after {nb_attempts} attempts : "
+                f"{exc!r}{details}",
+            )
+
+    def dead_letter_attachments(self, job: Job) -> dict[str, str]:
+        # Files that are written along with a job that failed for good
+        return {}
 
     def _log(self, level: str, job: Job, msg: str):
         logger.log(level, f"[{job.id_}] {msg}")
+
+
+@frozen
+class BatchWorker(Worker):
+    batch_size: ClassVar[int]
+    batch_timeout: ClassVar[float]
+
+    @abstractmethod
+    async def execute_batch(self, jobs: list[Job]) -> tuple[Any, list[Job]]: ...
+
+    async def loop(self):
+        while True:
+            jobs = await self.queue.get_batch(
+                self.type_, self.batch_size, self.batch_timeout
+            )
+
+            try:
+                await run_to_completion(self._handle_batch(jobs))
+            finally:
+                for job in jobs:
+                    self.queue.task_done(self.type_, job)
+
+    async def _handle_batch(self, jobs: list[Job]):
+        for job in jobs:
+            assert isinstance(job, self.type_)
+
+        try:
+            start = time.monotonic()
+            res, further_jobs = await self.execute_batch(jobs)
+            self.latency.update((time.monotonic() - start) / len(jobs))
+
+            if res is not None:
+                for job in jobs:
+                    self._log("DEBUG", job, f"Completed job {job.__class__.__name__}")
+
+            for j in further_jobs:
+                await self.queue.put(j)
+        except Exception:
+            # A single faulty job should not prevent the others from
+            # being handled, so they are retried one by one.
+            logger.warning(
+                f"Batch of {len(jobs)} {self.type_.__name__} failed, "
+                "falling back to one job at a time"
+            )
+            for job in jobs:
+                await self._handle(job)
+
+
+@define
+class WorkerPool:
+    worker: Worker
+    min_size: int
+    max_size: int
+    tasks: list[asyncio.Task] = field(factory=list)
+
+    @property
+    def name(self) -> str:
+        return self.worker.type_.__name__
+
+
+class Supervisor:
+    # Runs the loops of several workers, and adjusts the number of loops of
+    # each worker every `interval` seconds : a stage gets one more loop when
+    # the jobs that wait for it would take more than `target_drain_time`
+    # seconds to be handled (judging by the latency of its worker), and one
+    # less when no job waits for it.
+    def __init__(
+        self,
+        queue: JobQueue,
+        pools: list[WorkerPool],
+        interval: float,
+        target_drain_time: float,
+    ) -> None:
+        self.queue = queue
+        self.pools = pools
+        self.interval = interval
+        self.target_drain_time = target_drain_time
+
+    async def run(self):
+        async with asyncio.TaskGroup() as tg:
+            for pool in self.pools:
+                for _ in range(pool.min_size):
+                    pool.tasks.append(tg.create_task(pool.worker.loop()))
+
+            # Cancelling the supervisor cancels all the loops
+            try:
+                while True:
+                    await asyncio.sleep(self.interval)
+                    for pool in self.pools:
+                        self._scale(tg, pool)
+            except asyncio.CancelledError:
+                await self.queue.release_backpressure()
+                raise
+
+    def _scale(self, tg: asyncio.TaskGroup, pool: WorkerPool):
+        depth = self.queue.qsize()[pool.worker.type_]
+        nb_tasks = len(pool.tasks)
+        latency = pool.worker.latency.value
+
+        if depth == 0:
+            if nb_tasks > pool.min_size:
+                logger.info(f"Scaling {pool.name} down to {nb_tasks - 1} workers")
+                pool.tasks.pop().cancel()
+            return
+
+        if nb_tasks >= pool.max_size:
+            return
+
+        if nb_tasks == 0:
+            logger.info(f"Scaling {pool.name} up to 1 worker : {depth} jobs waiting")
+        elif (
+            latency is not None and depth * latency / nb_tasks > self.target_drain_time
+        ):
+            logger.info(
+                f"Scaling {pool.name} up to {nb_tasks + 1} workers : {depth} jobs "
+                f"waiting, {latency:.2f}s per job"
+            )
+        else:
+            return
+
+        pool.tasks.append(tg.create_task(pool.worker.loop()))
@@ -0,0 +1,67 @@
+import asyncio
+import tempfile
+from pathlib import Path
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from media_observer.article import MainArticle, TopArticle
+from media_observer.db.sqlite import SqliteBackend
+from media_observer.internet_archive import (
+    InternetArchiveSnapshot,
+    InternetArchiveSnapshotId,
+)
+from media_observer.medias import media_collection
+from media_observer.storage import Storage
+
+
+async def copy_frontpage(tmp_dir: str) -> list[str]:
+    storage = Storage(await SqliteBackend.create(str(Path(tmp_dir) / "test.db")))
+    await storage._create_db()
+
+    collection = next(iter(media_collection.values()))
+    dt = datetime(2024, 1, 1, tzinfo=ZoneInfo("UTC"))
+    snapshot = InternetArchiveSnapshot(
+        InternetArchiveSnapshotId(dt, collection.url, "DIGEST"), ""
+    )
+
+    # Relative and scheme-less links end up as "https://web.archive.org/..."
+    main = MainArticle.create("main", f"/web/20240101000000/{collection.url}/main")
+    top_articles = [
+        TopArticle.create(
+            "top 1", f"//web.archive.org/web/20240101000000/{collection.url}/1", 1
+        ),
+        TopArticle.create(
+            "top 2", f"http://web.archive.org/web/20240101000000/{collection.url}/2", 2
+        ),
+    ]
+    page = collection.FrontPageClass(snapshot, None, top_articles, main)
+
+    try:
+        await storage.add_page(collection, page, dt)
+        stored = await storage.find_frontpage_by_digest(collection.name, "DIGEST")
+
+        new_snapshot = InternetArchiveSnapshotId(
+            dt + timedelta(hours=6, minutes=3), collection.url, "DIGEST"
+        )
+        await storage.copy_frontpage(
+            stored["id"], new_snapshot, dt + timedelta(hours=6)
+        )
+
+        async with storage.backend.get_connection(readonly=True) as conn:
+            rows = await conn.execute_fetchall(
+                "SELECT url_archive FROM articles_on_frontpage WHERE frontpage_id != $1",
+                stored["id"],
+            )
+    finally:
+        await storage.close()
+
+    return [url for (url,) in rows]
+
+
+def test_copy_frontpage_rewrites_links():
+    with tempfile.TemporaryDirectory(prefix="media_observer") as tmp_dir:
+        urls = asyncio.run(copy_frontpage(tmp_dir))
+
+    assert len(urls) == 3
+    assert all("/web/20240101060300/" in url for url in urls), urls
+    assert any(url.startswith("https://web.archive.org/") for url in urls), urls
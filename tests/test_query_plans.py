@@ -0,0 +1,17 @@
+import asyncio
+import os
+import pytest
+
+from media_observer.query_plans import check_query_plans
+
+
+def test_sqlite_query_plans():
+    assert asyncio.run(check_query_plans(300))
+
+
+@pytest.mark.skipif(
+    "TEST_POSTGRES_URL" not in os.environ,
+    reason="Requires a PostgreSQL database, given by TEST_POSTGRES_URL",
+)
+def test_postgres_query_plans():
+    assert asyncio.run(check_query_plans(300, os.environ["TEST_POSTGRES_URL"]))
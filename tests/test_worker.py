@@ -0,0 +1,50 @@
+import asyncio
+import sqlite3
+import tempfile
+from pathlib import Path
+from uuid import uuid1
+from attrs import field, frozen
+
+from media_observer.worker import Job, JobPostponed, PersistentJobQueue, Worker
+
+
+@frozen
+class PostponedJob(Job): ...
+
+
+@frozen
+class PostponingWorker(Worker):
+    type_ = PostponedJob
+    # Each job is postponed once, then handled
+    postponed: set = field(factory=set)
+
+    async def execute(self, job: Job):
+        if job.id_ not in self.postponed:
+            self.postponed.add(job.id_)
+            raise JobPostponed(0.01)
+        return True, []
+
+
+async def run_postponed_job(file_path: Path) -> int:
+    queue = PersistentJobQueue([PostponedJob], file_path)
+    await queue.seed([PostponedJob(uuid1())])
+
+    task = asyncio.create_task(PostponingWorker(queue).loop())
+    try:
+        await asyncio.wait_for(queue.join(), 5)
+        assert not task.done()
+    finally:
+        task.cancel()
+        await queue.close()
+
+    conn = sqlite3.connect(file_path)
+    [(nb_rows,)] = conn.execute("SELECT COUNT(*) FROM jobs")
+    conn.close()
+    return nb_rows
+
+
+def test_postponed_job_is_removed_from_persistent_queue():
+    with tempfile.TemporaryDirectory(prefix="media_observer") as tmp_dir:
+        nb_rows = asyncio.run(run_postponed_job(Path(tmp_dir) / "jobs.db"))
+
+    assert nb_rows == 0